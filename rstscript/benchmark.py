@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import datetime
+import tracemalloc
+from io import StringIO
+
+import rstscript
+from rstscript import litrunner
+
+"""
+Benchmarks of the read, weave, format and tangle pipeline.
+
+Run it with ``python -m rstscript.benchmark``, it measures the stages on the
+given documents and on generated ones and reports the lines per second and
+the peak memory allocated by python. Every run is appended to a json history,
+with the change to the last run which measured the same thing.
+
+    python -m rstscript.benchmark performance/testfile.nw --chunks 1000
+"""
+
+#: the stages, every one includes the ones before
+STAGES = ('read','weave','format','tangle')
+
+
+def generate(chunks,lines=5):
+    """ a document with *chunks* pairs of text and code chunks of *lines*
+    lines each"""
+    document = []
+    for i in range(chunks):
+        document.append(''.join('Some text of paragraph {0} with {{{{x{0}}}}} in it.\n'
+            .format(i) for j in range(lines)))
+        document.append('%<\n' + ''.join('x{0} = {1} * {0}\n'.format(i,j)
+            for j in range(lines)) + '%>\n')
+    return ''.join(document)
+
+
+def stage(name,document):
+    """ runs the pipeline up to the stage on a fresh Litrunner"""
+    logger = logging.getLogger('rstscript.benchmark')
+    L = litrunner.Litrunner({},logger)
+    try:
+        chunks = L.read(StringIO(document))
+        if name in ('read','tangle'):
+            for chunk in chunks:
+                pass
+            if name == 'tangle':
+                L.tangled()
+        elif name == 'weave':
+            for cchunk in L.weave(chunks):
+                pass
+        else:
+            for chunkn,formatted in L.format(L.weave(chunks)):
+                L.chunks[chunkn]['woven'] = formatted
+            L.woven()
+    finally:
+        L.close()
+
+
+def measure(name,document,repeat=3):
+    """ best wall time of *repeat* runs and the peak python memory"""
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        stage(name,document)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best,t)
+    tracemalloc.start()
+    try:
+        stage(name,document)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    lines = document.count('\n')
+    return {'seconds':best,'lines':lines,'lines_per_second':lines/best if best else 0,
+            'peak_memory':peak}
+
+
+def run(documents,stages=STAGES,repeat=3):
+    """ returns the results of all stages for the documents, a dict by
+    name of the document"""
+    results = {}
+    for docname,document in documents:
+        for name in stages:
+            results['{0}:{1}'.format(docname,name)] = measure(name,document,repeat)
+    return results
+
+
+def load_history(path):
+    try:
+        with open(path,'r') as f:
+            return json.load(f)
+    except (IOError,OSError,ValueError):
+        return []
+
+
+def record(path,history,results):
+    """ appends the results to the history and writes it to *path*"""
+    history.append({'version':rstscript.__version__,
+        'date':datetime.datetime.now().isoformat(),
+        'python':platform.python_version(),'results':results})
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path,'w') as f:
+        json.dump(history,f,indent=1,sort_keys=True)
+
+
+def previous(history,key):
+    """ the last result of *key* in the history"""
+    for entry in reversed(history):
+        if key in entry['results']:
+            return entry['results'][key]
+
+
+def table(results,history):
+    lines = ['{0:<40}{1:>14}{2:>12}{3:>10}'.format('benchmark','lines/s',
+        'memory','change')]
+    for key,result in sorted(results.items()):
+        last = previous(history,key)
+        change = ''
+        if last and last['lines_per_second']:
+            change = '{0:+.1%}'.format(result['lines_per_second']/
+                    last['lines_per_second'] - 1)
+        lines.append('{0:<40}{1:>14.0f}{2:>10}KB{3:>10}'.format(key,
+            result['lines_per_second'],result['peak_memory']//1024,change))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the rstscript pipeline')
+    parser.add_argument('documents',nargs='*',
+            help='documents to measure, by default performance/testfile.nw if it exists')
+    parser.add_argument('--chunks',type=int,nargs='*',default=[100,1000],
+            help='measure generated documents with that many chunk pairs')
+    parser.add_argument('--lines',type=int,default=5,
+            help='lines of every generated chunk')
+    parser.add_argument('--stages',nargs='*',default=list(STAGES),
+            choices=STAGES,help='stages to measure')
+    parser.add_argument('--repeat',type=int,default=3,
+            help='take the best of that many runs')
+    parser.add_argument('--history',default=os.path.join('performance','history.json'),
+            help='json file with the results of earlier runs')
+    parser.add_argument('--no-history',dest='nohistory',action='store_true',
+            default=False,help='don\'t write the results to the history')
+    args = parser.parse_args(argv)
+    logging.getLogger('rstscript.benchmark').setLevel(logging.CRITICAL)
+    paths = args.documents
+    if not paths and os.path.exists(os.path.join('performance','testfile.nw')):
+        paths = [os.path.join('performance','testfile.nw')]
+    documents = []
+    for path in paths:
+        with open(path,'r') as f:
+            documents.append((os.path.basename(path),f.read()))
+    for n in args.chunks:
+        documents.append(('generated-{0}x{1}'.format(n,args.lines),
+            generate(n,args.lines)))
+    results = run(documents,args.stages,args.repeat)
+    history = load_history(args.history)
+    print(table(results,history))
+    if not args.nohistory:
+        record(args.history,history,results)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
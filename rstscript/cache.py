@@ -0,0 +1,180 @@
+import os
+import json
+import marshal
+import hashlib
+import tempfile
+import threading
+import collections
+
+
+def digest(*parts):
+    """ stable hex digest of some strings or bytes, unlike ``hash`` it
+    survives restarts of the interpreter"""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part,str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ChunkCache(object):
+    """ Persistent content addressed store of formatted chunk output
+
+    Every entry is a small json file named after its key, the keys are the
+    chained digests produced by ``Litrunner.read``. The modification time of
+    an entry is bumped on every hit, so evicting the oldest files first gives
+    a least recently used policy without the need of a separate index.
+    """
+
+    def __init__(self,directory,maxsize,logger):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.logger = logger
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.size = sum(size for path,size,mtime in self._entries())
+
+    def _path(self,key):
+        return os.path.join(self.directory,key[:2],key)
+
+    def _entries(self):
+        for root,dirs,files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root,name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path,st.st_size,st.st_mtime
+
+    def get(self,key):
+        path = self._path(key)
+        try:
+            with open(path,'r',encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path,None)
+            return value
+        except (IOError,OSError,ValueError):
+            return None
+
+    def set(self,key,value):
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        data = json.dumps(value).encode('utf-8')
+        try:
+            old = os.path.getsize(path)
+        except OSError:
+            old = 0
+        fd,tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd,'wb') as f:
+            f.write(data)
+        os.replace(tmp,path)
+        self.size += len(data) - old
+        if self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """ remove least recently used entries until we are below 90% of the
+        size budget"""
+        limit = self.maxsize * 0.9
+        entries = sorted(self._entries(),key=lambda x: x[2])
+        self.size = sum(size for path,size,mtime in entries)
+        for path,size,mtime in entries:
+            if self.size <= limit:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+        self.logger.info('evicted cache "{0}" down to {1} bytes'
+                .format(self.directory,self.size))
+
+
+def make_cache(options,logger):
+    """ returns a ChunkCache for the app options or None if caching is
+    disabled"""
+    if not options.get('cachedir') or options.get('nocache'):
+        return None
+    try:
+        # the figures, templates and compiled code have directories of
+        # their own there
+        return ChunkCache(os.path.join(options['cachedir'],'chunks'),
+                int(options.get('cachesize',100))*1024*1024,logger)
+    except (IOError,OSError) as e:
+        logger.error('couldn\'t use cache directory "{0}": {1}'
+                .format(options['cachedir'],e))
+        return None
+
+
+class CompileCache(object):
+    """ compiled statements of code chunks
+
+    The values are lists of tuples of code objects and plain values, which
+    are kept in memory, the *size* most recently used ones, and if there is
+    a *directory* also marshalled on disk, for the next start.
+    """
+
+    def __init__(self,directory=None,size=10000):
+        self.directory = directory
+        self.size = size
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _path(self,key):
+        return os.path.join(self.directory,key[:2],key)
+
+    def _remember(self,key,value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def get(self,key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        if self.directory:
+            try:
+                with open(self._path(key),'rb') as f:
+                    value = marshal.load(f)
+            except (IOError,OSError,ValueError,EOFError,TypeError):
+                return None
+            self._remember(key,value)
+            return value
+
+    def set(self,key,value):
+        self._remember(key,value)
+        if self.directory:
+            path = self._path(key)
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path),exist_ok=True)
+                fd,tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd,'wb') as f:
+                    marshal.dump(value,f)
+                os.replace(tmp,path)
+            except (IOError,OSError,ValueError):
+                pass
+
+
+#: compile caches by directory, shared by all projects of the process
+_compile_caches = {}
+_compile_caches_lock = threading.Lock()
+
+
+def make_compile_cache(options):
+    """ returns the CompileCache for the app options, it is on disk if
+    caching is enabled"""
+    directory = None
+    if options.get('cachedir') and not options.get('nocache'):
+        directory = os.path.join(options['cachedir'],'code')
+    with _compile_caches_lock:
+        if not directory in _compile_caches:
+            _compile_caches[directory] = CompileCache(directory)
+        return _compile_caches[directory]
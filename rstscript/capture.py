@@ -0,0 +1,69 @@
+import sys
+import threading
+import contextlib
+import contextvars
+
+"""
+Module to capture the output of the code executed by the processors.
+
+``sys.stdout`` and ``sys.stderr`` are replaced once by a ContextStream, which
+writes to the buffer set for the current thread or task, or to the real
+stream if there is none. So projects which execute at the same time in the
+threads of the daemon capture their own output, without swapping the streams
+of the whole process for every statement.
+
+Threads started by the executed code begin with an empty context, so they
+write to the real streams.
+"""
+
+stdout_buffer = contextvars.ContextVar('stdout_buffer',default=None)
+stderr_buffer = contextvars.ContextVar('stderr_buffer',default=None)
+
+_lock = threading.Lock()
+
+
+class ContextStream(object):
+    """ stands in for *stream*, writes go to the buffer in *var* if there is
+    one"""
+
+    def __init__(self,stream,var):
+        self.stream = stream
+        self.var = var
+
+    def target(self):
+        buffer = self.var.get()
+        return self.stream if buffer is None else buffer
+
+    def write(self,s):
+        return self.target().write(s)
+
+    def writelines(self,lines):
+        return self.target().writelines(lines)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self,name):
+        return getattr(self.target(),name)
+
+
+def install():
+    """ replaces sys.stdout and sys.stderr, unless they are replaced already"""
+    with _lock:
+        if not isinstance(sys.stdout,ContextStream):
+            sys.stdout = ContextStream(sys.stdout,stdout_buffer)
+        if not isinstance(sys.stderr,ContextStream):
+            sys.stderr = ContextStream(sys.stderr,stderr_buffer)
+
+
+@contextlib.contextmanager
+def capture(stdout,stderr):
+    """ the output of the current context goes to *stdout* and *stderr*"""
+    install()
+    out = stdout_buffer.set(stdout)
+    err = stderr_buffer.set(stderr)
+    try:
+        yield
+    finally:
+        stderr_buffer.reset(err)
+        stdout_buffer.reset(out)
@@ -0,0 +1,507 @@
+import os
+import sys
+import signal
+import socket
+import threading
+import traceback
+import itertools
+import subprocess
+import collections
+from multiprocessing.connection import Listener, Client, Connection
+
+from rstscript import timing
+
+"""
+Module to run a processor in a forked child process and keep copy on write
+snapshots of it after some chunks.
+
+ daemon [ForkedProcessor] <-> worker (executes the chunks)
+                          <-> snapshot after chunk 3 (sleeps)
+                          <-> snapshot after chunk 7 (sleeps)
+
+If a chunk before the current position of the worker needs to run again, the
+worker is thrown away and the nearest snapshot before that chunk forks a new
+worker, which continues from there. All processes connect to a listener of
+the ForkedProcessor and announce themselves, so the daemon can talk to all of
+them.
+
+Chunks can also be submitted without waiting for their output, that way the
+workers of several sessions execute at the same time.
+
+The fresh workers are not forked from the daemon, whose threads may hold
+locks at that moment, which would stay locked forever in the child, but from
+a helper python process with a single thread, one per process. If no worker
+can be started, the processor executes in the daemon, without snapshots.
+"""
+
+#: values bigger than that are not sent back for the templates
+MAX_VALUE_SIZE = 64*1024
+
+#: seconds to wait for a process to fork or connect, the first fork waits
+#: until the processor is imported
+CONNECT_TIMEOUT = 120
+
+#: the helpers forking the fresh workers by process
+_forkers = {}
+_forkers_lock = threading.Lock()
+
+
+class PipeLogger(object):
+    """ logger of the forked processes, sends the messages to the daemon"""
+
+    def __init__(self,conn):
+        self.conn = conn
+
+    def _send(self,level,msg):
+        self.conn.send(('log',level,str(msg)))
+
+    def debug(self,msg):
+        self._send('debug',msg)
+    def info(self,msg):
+        self._send('info',msg)
+    def warn(self,msg):
+        self._send('warn',msg)
+    def error(self,msg):
+        self._send('error',msg)
+    def exception(self,msg):
+        self._send('error','{0}\n{1}'.format(msg,traceback.format_exc()))
+
+    warning = warn
+
+
+def namespace(d):
+    """ the part of the namespace which can be sent to the daemon"""
+    import pickle
+    result = {}
+    for key,value in d.items():
+        if key.startswith('__') or sys.getsizeof(value) > MAX_VALUE_SIZE:
+            continue
+        try:
+            if len(pickle.dumps(value)) <= MAX_VALUE_SIZE:
+                result[key] = value
+        except Exception:
+            pass
+    return result
+
+
+def private_memory(pid):
+    """ memory in bytes the process doesn't share with others, 0 if we can't
+    find out"""
+    try:
+        with open('/proc/{0}/smaps_rollup'.format(pid),'r') as f:
+            return sum(int(line.split()[1])*1024 for line in f
+                    if line.startswith('Private_'))
+    except (IOError,OSError,ValueError):
+        return 0
+
+
+def _child(target,*args):
+    """ runs the target in a forked child, which must never get back into
+    the code of its parent"""
+    try:
+        target(*args)
+    finally:
+        os._exit(1)
+
+
+def _connect(address,kind,position):
+    conn = Client(address)
+    conn.send((kind,position,os.getpid()))
+    return conn
+
+
+def _worker(address,conn,processor):
+    signal.signal(signal.SIGCHLD,signal.SIG_DFL)
+    processor.logger = PipeLogger(conn)
+    if hasattr(processor,'visitor'):
+        processor.visitor.logger = processor.logger
+    snapshots = []
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            os._exit(0)
+        if msg[0] == 'wait':
+            conn.send(('waited',processor.wait() if hasattr(processor,'wait')
+                else True))
+        elif msg[0] == 'process':
+            chunk,snapshot = msg[1:]
+            try:
+                cchunks = list(processor.process(chunk))
+                report = processor.report.take() if hasattr(processor,'report') else {}
+                conn.send(('done',cchunks,namespace(processor.dict),report))
+            except Exception:
+                conn.send(('error',traceback.format_exc()))
+            if snapshot:
+                pid = os.fork()
+                if not pid:
+                    conn.close()
+                    _child(_snapshot,address,processor,chunk.number)
+                snapshots.append(pid)
+        else:
+            if hasattr(processor,'close'):
+                processor.close()
+            os._exit(0)
+        # reap the snapshots which were dropped meanwhile
+        for pid in list(snapshots):
+            try:
+                if os.waitpid(pid,os.WNOHANG)[0]:
+                    snapshots.remove(pid)
+            except OSError:
+                snapshots.remove(pid)
+
+
+def _snapshot(address,processor,position):
+    # we never execute anything here, so we can reap our workers silently
+    signal.signal(signal.SIGCHLD,signal.SIG_IGN)
+    conn = _connect(address,'snapshot',position)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            os._exit(0)
+        if msg[0] == 'resume':
+            if not os.fork():
+                conn.close()
+                _child(_resumed_worker,address,processor,position)
+        else:
+            os._exit(0)
+
+
+def _resumed_worker(address,processor,position):
+    _worker(address,_connect(address,'worker',position),processor)
+
+
+def _fresh_worker(address,Processor,options):
+    conn = _connect(address,'worker',-1)
+    _worker(address,conn,Processor(options,PipeLogger(conn)))
+
+
+def _forker(fd):
+    """ the helper, forks a fresh worker for every message, the processor
+    class is unpickled, so imported, here once"""
+    # nobody waits for the workers but the system
+    signal.signal(signal.SIGCHLD,signal.SIG_IGN)
+    conn = Connection(fd)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError,OSError):
+            os._exit(0)
+        except Exception:
+            # a processor we can't import
+            conn.send(('error',traceback.format_exc()))
+            continue
+        pid = os.fork()
+        if not pid:
+            conn.close()
+            _child(_fresh_worker,*msg)
+        conn.send(('forked',pid))
+
+
+def fork(address,Processor,options):
+    """ forks a fresh worker, which connects to *address*, from the helper
+    of this process, returns its pid"""
+    with _forkers_lock:
+        conn,process = _forkers.get(os.getpid(),(None,None))
+        if not process or process.poll() is not None:
+            ours,theirs = socket.socketpair()
+            # it needs to find us like we do
+            process = subprocess.Popen([sys.executable,'-c','import sys\n'
+                'sys.path[:] = {0!r}\nfrom rstscript import checkpoint\n'
+                'checkpoint._forker({1})'.format(sys.path,theirs.fileno())],
+                pass_fds=[theirs.fileno()])
+            theirs.close()
+            conn = Connection(ours.detach())
+            _forkers[os.getpid()] = (conn,process)
+        conn.send((address,Processor,options))
+        try:
+            if not conn.poll(CONNECT_TIMEOUT):
+                raise TimeoutError('the helper didn\'t fork a worker in {0} '
+                        'seconds'.format(CONNECT_TIMEOUT))
+            kind,value = conn.recv()
+        except (EOFError,OSError):
+            # a late answer would be taken for the next worker
+            del _forkers[os.getpid()]
+            process.kill()
+            conn.close()
+            raise
+    if kind == 'error':
+        raise RuntimeError('the helper couldn\'t fork a worker:\n{0}'
+                .format(value))
+    return value
+
+
+class ForkedProcessor(object):
+    """ runs a forkable processor in a child process and resumes from
+    snapshots if earlier chunks have to run again
+
+    *checkpoints* of the app options is the number of executed chunks after
+    which a new snapshot is taken, without it no snapshots are taken,
+    *checkpointmemory* the budget in MB for all snapshots, if it is exceeded
+    snapshots are thinned out.
+    """
+
+    def __init__(self,Processor,appoptions,logger):
+        self.Processor = Processor
+        self.name = Processor.name
+        self.options = appoptions
+        self.logger = logger
+        self.spacing = int(appoptions.get('checkpoints') or 0)
+        self.budget = int(appoptions.get('checkpointmemory',0))*1024*1024
+        self.listener = Listener(family='AF_UNIX')
+        # processes which die before they connect mustn't block us
+        self.listener._listener._socket.settimeout(CONNECT_TIMEOUT)
+        #: the processor in the daemon, if we couldn't start a worker
+        self.local = None
+        self.forks = True
+        self.dict = {}
+        #: the measurements of the chunks the worker executed
+        self.report = timing.Report()
+        #: the chunks of the current document by number
+        self.history = {}
+        #: snapshot connections and pids by chunk number
+        self.snapshots = {}
+        #: number and digest of the chunks the worker and the snapshots
+        #: executed, to know if they still fit the document
+        self.trail = []
+        self.trails = {}
+        self.conn = None
+        self.pid = None
+        #: the worker has the state after this chunk
+        self.position = -1
+        #: the last chunk sent to the worker
+        self.sent = -1
+        #: chunks sent to the worker and the outputs we received for them
+        self.pending = collections.deque()
+        self.ready = collections.deque()
+        self.since_snapshot = 0
+
+    def _accept(self):
+        conn = self.listener.accept()
+        kind,position,pid = conn.recv()
+        return conn,position,pid
+
+    def _start(self):
+        """ start a fresh worker with an empty namespace, or a processor in
+        the daemon if that fails"""
+        self.since_snapshot = 0
+        self.trail = []
+        if self.forks:
+            try:
+                fork(self.listener.address,self.Processor,self.options)
+                self.conn,self.position,self.pid = self._accept()
+                return
+            except Exception as e:
+                self.forks = False
+                self.logger.error('couldn\'t start a worker for processor '
+                        '"{0}", executing in the daemon: {1}'.format(self.name,e))
+        self.local = self.Processor(self.options,self.logger)
+        self.position = -1
+
+    def _stop_worker(self):
+        if self.conn:
+            # it isn't our child, it is gone when it hung up
+            try:
+                self.conn.send(('exit',))
+                while self.conn.poll(CONNECT_TIMEOUT):
+                    self.conn.recv()
+            except (EOFError,IOError,OSError):
+                pass
+            self.conn.close()
+        if self.local and hasattr(self.local,'close'):
+            self.local.close()
+        self.local = None
+        self.conn = None
+        self.position = -1
+        self.sent = -1
+        self.trail = []
+        self.pending.clear()
+
+    def _drop_snapshot(self,position):
+        conn,pid = self.snapshots.pop(position)
+        del self.trails[position]
+        try:
+            conn.send(('exit',))
+        except (IOError,OSError):
+            pass
+        conn.close()
+
+    def _thin_out(self):
+        """ drop snapshots until we are in the memory budget, always the one
+        closest to its predecessor, to keep them evenly spread"""
+        while self.budget and len(self.snapshots) > 1 and sum(private_memory(pid)
+                for conn,pid in self.snapshots.values()) > self.budget:
+            positions = sorted(self.snapshots)
+            gaps = [(b-a,b) for a,b in zip([-1]+positions,positions)]
+            self._drop_snapshot(min(gaps)[1])
+            self.logger.info('dropped snapshot, above memory budget')
+
+    def rewind(self,number):
+        """ get a worker with the state right before the chunk *number* or
+        earlier"""
+        self._stop_worker()
+        for position in [p for p in self.snapshots if p >= number]:
+            self._drop_snapshot(position)
+        if self.snapshots:
+            position = max(self.snapshots)
+            try:
+                self.snapshots[position][0].send(('resume',))
+                self.conn,self.position,self.pid = self._accept()
+            except (EOFError,IOError,OSError) as e:
+                self.logger.error('couldn\'t resume from snapshot after chunk '
+                        '"{0}": {1}'.format(position,e))
+                self._drop_snapshot(position)
+                return self.rewind(number)
+            self.trail = list(self.trails[position])
+            self.logger.info('resumed from snapshot after chunk "{0}"'
+                    .format(position))
+
+    def _receive(self):
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError,IOError,OSError):
+                self.logger.error('the worker process died')
+                self._stop_worker()
+                return []
+            if msg[0] == 'log':
+                getattr(self.logger,msg[1])(msg[2])
+            elif msg[0] == 'error':
+                self.logger.error('processing failed:\n{0}'.format(msg[1]))
+                return []
+            else:
+                # in place, the litrunner has a view on it
+                self.dict.clear()
+                self.dict.update(msg[2])
+                self.report.merge(msg[3])
+                return msg[1]
+
+    def _send(self,chunk,keep=True):
+        self.history[chunk.number] = chunk
+        if not self.conn and not self.local:
+            self._start()
+        if self.local:
+            cchunks = list(self.local.process(chunk))
+            self.dict.clear()
+            self.dict.update(self.local.dict)
+            if hasattr(self.local,'report'):
+                self.report.merge(self.local.report.take())
+            self.trail.append((chunk.number,chunk.digest))
+            self.position = self.sent = chunk.number
+            if keep:
+                self.ready.append(cchunks)
+            return
+        self.since_snapshot += 1
+        snapshot = bool(self.spacing) and self.since_snapshot >= self.spacing
+        if snapshot:
+            self.since_snapshot = 0
+        self.conn.send(('process',chunk,snapshot))
+        self.trail.append((chunk.number,chunk.digest))
+        self.pending.append((chunk,snapshot,keep))
+        self.sent = chunk.number
+
+    def _collect(self):
+        """ receives the output of the oldest pending chunk"""
+        chunk,snapshot,keep = self.pending.popleft()
+        cchunks = self._receive()
+        if self.conn:
+            self.position = chunk.number
+            if snapshot:
+                try:
+                    conn,position,pid = self._accept()
+                except (EOFError,IOError,OSError) as e:
+                    self.logger.error('couldn\'t take a snapshot after chunk '
+                            '"{0}": {1}'.format(chunk.number,e))
+                    snapshot = False
+            if snapshot:
+                if position in self.snapshots:
+                    # a replayed chunk, the old snapshot is still there
+                    self._drop_snapshot(position)
+                self.snapshots[position] = (conn,pid)
+                self.trails[position] = [(number,digest) for number,digest
+                        in self.trail if number <= position]
+                self._thin_out()
+        if keep:
+            self.ready.append(cchunks)
+
+    def update(self,history):
+        """ takes the chunks of the current document by number, the snapshots
+        which executed other chunks before their position are thrown away,
+        the worker is rewound to the last snapshot before the first chunk
+        it executed which isn't in the document like that anymore"""
+        while self.pending:
+            self._collect()
+        self.history = history
+        def mismatch(trail):
+            expected = [(number,history[number].digest) for number
+                    in sorted(history) if trail and number <= trail[-1][0]]
+            for a,b in itertools.zip_longest(trail,expected):
+                if a != b:
+                    return min(x[0] for x in (a,b) if x)
+        for position in [p for p in self.snapshots
+                if mismatch(self.trails[p]) is not None]:
+            self._drop_snapshot(position)
+        number = mismatch(self.trail)
+        if number is not None:
+            self.rewind(number)
+            self.sent = self.position
+
+    def submit(self,chunk,keep=True):
+        """ sends the chunk to the worker without waiting for it, the
+        outputs are returned by ``result`` in the order of submission, if
+        *keep* is False the output is thrown away"""
+        if chunk.number <= self.sent:
+            while self.pending:
+                self._collect()
+            self.rewind(chunk.number)
+            self.sent = self.position
+        # chunks between the position and this one didn't change, but their
+        # state is missing
+        for number in sorted(n for n in self.history
+                if self.sent < n < chunk.number):
+            self.logger.info('replaying chunk "{0}"'.format(number))
+            self._send(self.history[number],keep=False)
+        self._send(chunk,keep)
+
+    def result(self):
+        """ waits for the output of the oldest submitted chunk"""
+        while not self.ready and self.pending:
+            self._collect()
+        return self.ready.popleft() if self.ready else []
+
+    def process(self,chunk):
+        self.submit(chunk)
+        yield from self.result()
+
+    def wait(self):
+        """ waits until the worker finished everything it does in the
+        background, like writing figures"""
+        # the outputs of replayed chunks come first
+        while self.pending:
+            self._collect()
+        if self.local:
+            return self.local.wait() if hasattr(self.local,'wait') else True
+        if not self.conn:
+            return True
+        self.conn.send(('wait',))
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError,IOError,OSError):
+                self.logger.error('the worker process died')
+                self._stop_worker()
+                return False
+            if msg[0] == 'log':
+                getattr(self.logger,msg[1])(msg[2])
+            elif msg[0] == 'waited':
+                return msg[1]
+            else:
+                self.logger.error('unexpected message "{0}" of the worker'
+                        .format(msg[0]))
+
+    def close(self):
+        self._stop_worker()
+        for position in list(self.snapshots):
+            self._drop_snapshot(position)
+        self.listener.close()
@@ -22,6 +22,8 @@ class Client(object):
                 self.timedout)
         self.pull_loop = ioloop.IOLoop()
         self.answer = None
+        #: version of the document the server saw last
+        self.version = None
 
     def connect(self):
         self.answer_sock = self.context.socket(zmq.REQ)
@@ -50,7 +52,7 @@ class Client(object):
         self.answer_loop.start()
         return True
 
-    def run(self,data):
+    def run(self,data,msg_type='run'):
         self.pull_port = self.pull_sock.bind_to_random_port(
                 'tcp://*', min_port=self.min_port,
                 max_port=self.max_port, max_tries=self.max_tries)
@@ -58,14 +60,27 @@ class Client(object):
         stream_pull.on_recv(self.pull_handler)
         data['port'] = self.pull_port
         data['host'] = self.host
-        self.answer_sock.send_json(['run',data])
+        self.answer_sock.send_json([msg_type,data])
         self.answer_loop.start()
         self.pull_loop.start()
 
+    def patch(self,data,delta):
+        """ like run, but sends only an edit of the document, see
+        ``Litrunner.patch`` for the format of *delta*"""
+        delta.setdefault('version',self.version)
+        data['delta'] = delta
+        self.run(data,msg_type='patch')
+
     def pull_handler(self,data):
         msg = jsonapi.loads(data[-1])
         if msg[0] == 'done':
-            print('\nFinnished job',msg[1])
+            if 'plan' in msg[1]:
+                print('chunks to run',msg[1]['plan'])
+            else:
+                self.version = msg[1].get('version')
+                if 'timings' in msg[1]:
+                    print(msg[1].pop('timings'))
+                print('\nFinnished job',msg[1])
             self.pull_loop.stop()
         elif msg[0] == 'log':
             print(msg[1])
@@ -0,0 +1,292 @@
+import ast
+import collections
+
+from rstscript import cache
+
+"""
+Module to find out which chunks have to be executed again after some chunks
+changed. For every python code chunk the names it defines and uses are
+collected from its ast, a chunk depends on the last chunk before it, which
+defined one of its names. As all chunks share one namespace, a chunk which
+just mutates a name (``a.b = 1``, ``a[0] = 1``, ``a.append(1)``,
+``setattr(a,'b',1)``) is treated as defining it. Calling a function of an
+imported module might change the module (``random.seed(1)``) and the names
+passed to it (``random.shuffle(l)``), unless the module is known to be pure,
+so such a call defines them too. Text chunks
+depend on the chunks defining the template variables they use. Everything
+we can't follow (star imports, ``exec``, ``globals()``, syntax errors) makes
+the chunk a barrier, which depends on all previous chunks and on which all
+following chunks depend.
+"""
+
+#: calls which give access to the namespace in ways we can't follow
+DYNAMIC = ('exec','eval','globals','locals','vars','__import__')
+#: calls which change the object passed first
+SETTERS = ('setattr','delattr')
+#: modules whose functions change neither themselves nor their arguments
+PURE = ('math','cmath','json','re','string','textwrap','operator',
+        'statistics','fractions','decimal','os.path','itertools','functools')
+
+Names = collections.namedtuple('Names',
+        ['defined','used','mutated','imports','barrier','calls'])
+
+
+def pure(module,path):
+    """ if calling *path* of *module*, like ``seed`` of ``random``, leaves
+    everything alone, *path* is None if we can't follow it"""
+    if path is None:
+        return False
+    full = '.'.join(part for part in (module,path) if part)
+    return any(full == name or full.startswith(name + '.') for name in PURE)
+
+
+class NameCollector(ast.NodeVisitor):
+    """ collects the names a chunk defines and uses on module level, names
+    used inside of functions are counted as used, as they are looked up when
+    the function is called"""
+
+    def __init__(self):
+        self.defined = set()
+        self.used = set()
+        self.mutated = set()
+        self.imports = {}
+        self.barrier = False
+        self.depth = 0
+        #: the calls as the name they start with, the dotted path after it
+        #: and the names passed to them
+        self.calls = []
+
+    def _root(self,node):
+        # the name an attribute or subscript chain starts with
+        while isinstance(node,(ast.Attribute,ast.Subscript,ast.Call)):
+            node = node.func if isinstance(node,ast.Call) else node.value
+        if isinstance(node,ast.Name):
+            return node.id
+
+    def _scope(self,node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    def visit_Name(self,node):
+        if isinstance(node.ctx,ast.Load):
+            self.used.add(node.id)
+        elif self.depth == 0:
+            self.defined.add(node.id)
+
+    def visit_FunctionDef(self,node):
+        if self.depth == 0:
+            self.defined.add(node.name)
+        self._scope(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Lambda(self,node):
+        self._scope(node)
+
+    visit_ListComp = visit_Lambda
+    visit_SetComp = visit_Lambda
+    visit_DictComp = visit_Lambda
+    visit_GeneratorExp = visit_Lambda
+
+    def visit_Global(self,node):
+        self.defined.update(node.names)
+
+    def visit_Import(self,node):
+        for alias in node.names:
+            if alias.asname:
+                name,module = alias.asname,alias.name
+            else:
+                name = module = alias.name.split('.')[0]
+            if self.depth == 0:
+                self.defined.add(name)
+                self.imports[name] = module
+
+    def visit_ImportFrom(self,node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.barrier = True
+            elif self.depth == 0:
+                self.defined.add(alias.asname or alias.name)
+                self.imports[alias.asname or alias.name] = '.'.join(
+                        part for part in (node.module,alias.name) if part)
+
+    def visit_Attribute(self,node):
+        if not isinstance(node.ctx,ast.Load):
+            name = self._root(node)
+            if name:
+                self.defined.add(name)
+        self.generic_visit(node)
+
+    visit_Subscript = visit_Attribute
+
+    def visit_Call(self,node):
+        if isinstance(node.func,ast.Name) and node.func.id in DYNAMIC:
+            self.barrier = True
+        arguments = [self._root(arg) for arg in node.args] + [
+                self._root(keyword.value) for keyword in node.keywords]
+        if (isinstance(node.func,ast.Name) and node.func.id in SETTERS and
+                arguments and arguments[0]):
+            self.defined.add(arguments[0])
+        # calling a method might change the object, e.g. ``a.append(1)``
+        if isinstance(node.func,ast.Attribute):
+            name = self._root(node.func)
+            if name:
+                self.mutated.add(name)
+        path = []
+        func = node.func
+        while isinstance(func,ast.Attribute):
+            path.insert(0,func.attr)
+            func = func.value
+        name = self._root(node.func)
+        if name:
+            self.calls.append((name,'.'.join(path) if isinstance(func,ast.Name)
+                else None,set(arg for arg in arguments if arg)))
+        self.generic_visit(node)
+
+
+def names(source):
+    """ returns the names defined and used by the source of a python chunk"""
+    collector = NameCollector()
+    try:
+        collector.visit(ast.parse(source))
+    except SyntaxError:
+        collector.barrier = True
+    return Names(collector.defined,collector.used,collector.mutated,
+            collector.imports,collector.barrier,collector.calls)
+
+
+class DependencyGraph(object):
+    """ dependencies between the chunks of a document
+
+    ``deps`` maps every chunk number to the set of numbers of the chunks it
+    directly depends on, ``dependents`` is the reverse mapping. *variables*
+    returns the names the text of a text chunk uses, without it text chunks
+    depend on all code before them.
+    """
+
+    def __init__(self,chunks,known=None,variables=None):
+        self.chunks = chunks
+        self.names = {}
+        #: the names of the chunks by digest, pass the ``known`` of the graph
+        #: of the last run to save parsing unchanged chunks again
+        self.known = {}
+        known = known or {}
+        #: the template variables of the text chunks by number
+        self.variables = {}
+        self.deps = {}
+        self.dependents = collections.defaultdict(set)
+        #: last chunk which defined a name
+        last_def = {}
+        #: the module names are bound to
+        modules = {}
+        #: last barrier and all code chunks since then
+        last_barrier = None
+        code = []
+        for chunk in chunks:
+            deps = set()
+            if chunk.type == 'text' and variables:
+                n = known.get(chunk.digest) or Names(set(),
+                        set(variables(chunk.raw)),set(),{},False,[])
+                self.known[chunk.digest] = n
+                self.variables[chunk.number] = n.used
+                deps.update(last_def[name] for name in n.used if name in last_def)
+                if any(not name in last_def for name in n.used):
+                    # maybe from somewhere we don't follow
+                    deps.update(code)
+                if last_barrier is not None:
+                    deps.add(last_barrier)
+            elif chunk.type == 'text':
+                # text chunks are rendered with the namespace, so they depend
+                # on all code before
+                deps.update(code)
+            elif chunk.options.get('proc','python') == 'python':
+                n = known.get(chunk.digest) or names(chunk.raw)
+                self.known[chunk.digest] = n
+                modules.update(n.imports)
+                mutated = set(name for name in n.mutated if not name in modules)
+                for name,path,arguments in n.calls:
+                    if name in modules and not pure(modules[name],path):
+                        mutated.add(name)
+                        mutated.update(arguments)
+                n = n._replace(defined=n.defined | mutated)
+                self.names[chunk.number] = n
+                if n.barrier:
+                    deps.update(code)
+                    last_barrier = chunk.number
+                    code = []
+                else:
+                    deps.update(last_def[name] for name in n.used | n.defined
+                            if name in last_def)
+                    if last_barrier is not None:
+                        deps.add(last_barrier)
+                for name in n.defined:
+                    last_def[name] = chunk.number
+                code.append(chunk.number)
+            self.deps[chunk.number] = deps
+            for dep in deps:
+                self.dependents[dep].add(chunk.number)
+        self.last_def = last_def
+        self.last_barrier = last_barrier
+
+    def ancestors(self,number):
+        """ all chunks which have to run before the chunk"""
+        result = set()
+        todo = list(self.deps.get(number,()))
+        while todo:
+            n = todo.pop()
+            if not n in result:
+                result.add(n)
+                todo.extend(self.deps[n])
+        return result
+
+    def _overwritten(self,number):
+        """ the chunks which defined names the chunk uses, if the names were
+        changed by the chunk itself or some later chunk in the namespace
+        meanwhile, they need to run again to restore the names"""
+        n = self.names.get(number)
+        if not n:
+            return set()
+        if self.last_barrier is not None and self.last_barrier > number:
+            return set(self.deps[number])
+        return set(d for d in self.deps[number] if d in self.names and
+                any(self.last_def.get(name,-1) >= number
+                    for name in self.names[d].defined & n.used))
+
+    def select(self,changed,undefined=()):
+        """ returns the chunks which need to run if *changed* changed,
+        *undefined* are the names changed or removed chunks defined before,
+        the chunks which use them now run again with the chunks which define
+        them now, the namespace still has the old values"""
+        result = set()
+        todo = list(changed)
+        undefined = set(undefined)
+        for number,used in self._uses():
+            if used & undefined:
+                todo.append(number)
+                todo.extend(d for d in self.deps[number] if d in self.names
+                        and self.names[d].defined & used & undefined)
+        while todo:
+            n = todo.pop()
+            if not n in result:
+                result.add(n)
+                todo.extend(self.dependents[n])
+                todo.extend(self._overwritten(n))
+        return result
+
+    def _uses(self):
+        """ the numbers of the chunks and the names they use"""
+        for number,n in self.names.items():
+            yield number,n.used
+        for number,used in self.variables.items():
+            yield number,used
+
+    def digests(self,seed):
+        """ digest of every chunk, including the digests of all its
+        ancestors"""
+        result = {}
+        for chunk in self.chunks:
+            result[chunk.number] = cache.digest(seed,chunk.digest,
+                    *[result[dep] for dep in sorted(self.deps[chunk.number])])
+        return result
@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+from rstscript import litrunner
+from rstscript import benchmark
+
+"""
+Benchmark of the latency of runs after small edits.
+
+A synthetic document is generated and one Litrunner is kept alive, like the
+daemon does with a project. Then lines are edited at the beginning, in the
+middle and at the end of the document, in text and in code chunks, and the
+time of the run after every edit is measured. The edits are written to the
+file or, with ``--patch``, sent as deltas like ``rstscript --diff`` does.
+
+    python -m rstscript.editbench --chunks 200 --structure chain --repeat 20
+"""
+
+#: how the code chunks depend on each other
+STRUCTURES = ('chain','fanout','independent')
+POSITIONS = ('begin','middle','end')
+
+
+def synthetic(chunks,structure='chain',textlines=3,figures=0):
+    """ generates a document with *chunks* pairs of text and code chunks,
+    every *figures* th code chunk makes an autofigure
+
+    Returns the lines of the document and the editable lines as dict of
+    ``(kind,position)`` to ``(index,make)``, ``make(value)`` gives the line
+    with another value.
+    """
+    lines = []
+    editable = {}
+    if figures:
+        lines.extend(['%<\n','from matplotlib import pyplot\n','%>\n'])
+    positions = list(zip((0,chunks//2,chunks - 1),POSITIONS))
+    for i in range(chunks):
+        maketext = lambda value,i=i: 'Paragraph {0} shows {{{{x{0}}}}}, edit {1}.\n'.format(i,value)
+        textindex = len(lines)
+        lines.append(maketext(0))
+        lines.extend('Some more words for paragraph {0}.\n'.format(i)
+                for j in range(textlines - 1))
+        figure = figures and i % figures == 0
+        if figure:
+            lines.append("%<{{'af':True,'label':'fig{0}'}}\n".format(i))
+        else:
+            lines.append('%<\n')
+        dep = ''
+        if i and structure == 'chain':
+            dep = 'x{0} + '.format(i - 1)
+        elif i and structure == 'fanout':
+            dep = 'x0 + '
+        makecode = lambda value,i=i,dep=dep: 'x{0} = {1}{2}\n'.format(i,dep,value)
+        codeindex = len(lines)
+        lines.append(makecode(1))
+        if figure:
+            lines.append('pyplot.plot([0, x{0}])\n'.format(i))
+        lines.append('%>\n')
+        for number,position in positions:
+            if i == number:
+                editable[('text',position)] = (textindex,maketext)
+                editable[('code',position)] = (codeindex,makecode)
+    return lines,editable
+
+
+def percentiles(times):
+    times = sorted(times)
+    at = lambda q: times[min(len(times) - 1,int(round(q*(len(times) - 1))))]
+    return {'p50':at(0.5),'p90':at(0.9),'p99':at(0.99),'max':times[-1],
+            'runs':len(times)}
+
+
+def measure(lines,editable,repeat=10,patch=False,cache=False):
+    """ runs the document once and then after every edit, returns the time
+    of the first run and the latency percentiles by edit"""
+    tmpdir = tempfile.mkdtemp()
+    lines = list(lines)
+    options = {'input':os.path.join(tmpdir,'document.nw'),
+            'woutput':os.path.join(tmpdir,'document.rst'),
+            'figdir':os.path.join(tmpdir,'_figures'),'options':{}}
+    if cache:
+        options['cachedir'] = os.path.join(tmpdir,'cache')
+    def write():
+        with open(options['input'],'w') as f:
+            f.write(''.join(lines))
+    L = litrunner.Litrunner(options,logging.getLogger('rstscript.editbench'))
+    try:
+        write()
+        t = time.perf_counter()
+        L.run()
+        results = {'first run':time.perf_counter() - t}
+        for position in POSITIONS:
+            for kind in ('text','code'):
+                index,make = editable[(kind,position)]
+                times = []
+                for value in range(2,repeat + 2):
+                    version = L.version
+                    lines[index] = make(value)
+                    write()
+                    delta = None
+                    if patch:
+                        delta = {'version':version,'first':index + 1,
+                                'last':index + 1,'text':lines[index]}
+                    t = time.perf_counter()
+                    L.run(delta)
+                    times.append(time.perf_counter() - t)
+                results['{0}-{1}'.format(kind,position)] = percentiles(times)
+        return results
+    finally:
+        L.close()
+        shutil.rmtree(tmpdir)
+
+
+def table(results):
+    lines = ['first run {0:.3f}s'.format(results['first run']),
+            '{0:<16}{1:>10}{2:>10}{3:>10}{4:>10}'.format('edit','p50','p90','p99','max')]
+    for position in POSITIONS:
+        for kind in ('text','code'):
+            name = '{0}-{1}'.format(kind,position)
+            lines.append('{0:<16}{1[p50]:>9.4f}s{1[p90]:>9.4f}s{1[p99]:>9.4f}s'
+                    '{1[max]:>9.4f}s'.format(name,results[name]))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the latency of '
+            'runs after edits')
+    parser.add_argument('--chunks',type=int,default=200,
+            help='number of text and code chunk pairs')
+    parser.add_argument('--structure',default='chain',choices=STRUCTURES,
+            help='how the code chunks depend on each other')
+    parser.add_argument('--text-lines',dest='textlines',type=int,default=3,
+            help='lines of every text chunk')
+    parser.add_argument('--figures',type=int,default=0,
+            help='every that many code chunks makes a figure, 0 for none')
+    parser.add_argument('--repeat',type=int,default=10,
+            help='number of edits at every place')
+    parser.add_argument('--patch',action='store_true',default=False,
+            help='send the edits as deltas instead of reading the file')
+    parser.add_argument('--cache',action='store_true',default=False,
+            help='use the persistent chunk cache')
+    parser.add_argument('--history',default=os.path.join('performance','history.json'),
+            help='json file with the results of earlier runs')
+    parser.add_argument('--no-history',dest='nohistory',action='store_true',
+            default=False,help='don\'t write the results to the history')
+    args = parser.parse_args(argv)
+    logging.getLogger('rstscript.editbench').setLevel(logging.CRITICAL)
+    lines,editable = synthetic(args.chunks,args.structure,args.textlines,args.figures)
+    results = measure(lines,editable,args.repeat,args.patch,args.cache)
+    print(table(results))
+    if not args.nohistory:
+        name = 'latency:{0}-{1}x{2}{3}'.format(args.structure,args.chunks,
+                args.textlines,':patch' if args.patch else '')
+        benchmark.record(args.history,benchmark.load_history(args.history),
+                {name:results})
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,257 @@
+import os
+import json
+import filecmp
+import shutil
+import threading
+import multiprocessing
+from concurrent import futures
+
+from rstscript import cache
+
+"""
+Module to save the figures of the processors without waiting for them.
+
+A figure is drawn by the Agg canvas in the process of the processor, which
+needs the figure objects anyway, but encoding the pixels to png and writing
+the file is done by a pool of processes, while the next chunks execute. The
+pool is spawned, not forked, so it doesn't matter which threads the daemon
+runs at the moment. There is one pool per process, started when the first
+figure is written, as starting one costs the import of numpy and matplotlib.
+The processor waits for all figures before the output files of a run are
+written.
+
+The pixels of a drawn figure are hashed, if the figure file already has them
+nothing is written at all. The encoded figures are kept in a content
+addressed store in the cache directory, from which they are copied to their
+places, so figures which look the same are encoded only once, also if they
+belong to different projects. They are copies and not hard links, so using a
+figure of the store again doesn't touch the files of the other projects.
+"""
+
+#: the stores by directory, shared by all projects of the process
+_stores = {}
+_stores_lock = threading.Lock()
+#: the pools by process and number of workers, shared by all projects
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _copy(source,target):
+    """ puts a copy of the file *source* at *target*"""
+    tmp = '{0}.{1}.tmp'.format(target,os.getpid())
+    shutil.copyfile(source,tmp)
+    os.replace(tmp,target)
+
+
+def _encode(data,width,height,dpi,path,target=None):
+    """ writes the rgba pixels of a canvas as png, like ``savefig`` does,
+    and copies it to *target*"""
+    import numpy
+    from matplotlib import image
+    pixels = numpy.frombuffer(data,numpy.uint8).reshape((height,width,4))
+    tmp = '{0}.{1}.tmp'.format(path,os.getpid())
+    image.imsave(tmp,pixels,format='png',dpi=dpi)
+    os.replace(tmp,path)
+    if target:
+        _copy(path,target)
+    return target or path
+
+
+class FigureStore(object):
+    """ content addressed store of encoded figures, with an index of the
+    digests of the figure files we wrote, without *directory* only the
+    index is kept in memory"""
+
+    def __init__(self,directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.index = {}
+        if directory:
+            try:
+                with open(os.path.join(directory,'index.json'),'r') as f:
+                    self.index = json.load(f)
+            except (IOError,OSError,ValueError):
+                pass
+
+    def path(self,key):
+        """ where the figure with the digest *key* is stored, None if there
+        is no store"""
+        if self.directory:
+            path = os.path.join(self.directory,key[:2],key + '.png')
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path),exist_ok=True)
+            return path
+
+    def get(self,key):
+        path = self.path(key)
+        try:
+            # we are in the cache directory, mark it as recently used
+            os.utime(path,None)
+            return path
+        except (TypeError,OSError):
+            return None
+
+    def current(self,target,key):
+        """ True if the file *target* is the figure with digest *key*"""
+        try:
+            st = os.stat(target)
+        except OSError:
+            return False
+        return self.index.get(target) == [key,st.st_mtime_ns,st.st_size]
+
+    def record(self,target,key):
+        st = os.stat(target)
+        with self.lock:
+            self.index[target] = [key,st.st_mtime_ns,st.st_size]
+
+    def restore(self,target,key,write=True):
+        """ makes sure the file *target* is the figure with digest *key*,
+        copies it from the store if not, without *write* only checks that we
+        could, returns False if the store doesn't have it"""
+        if self.current(target,key):
+            return True
+        stored = self.get(key)
+        if not stored:
+            return False
+        if os.path.exists(target) and filecmp.cmp(stored,target,shallow=False):
+            self.record(target,key)
+        elif write:
+            os.makedirs(os.path.dirname(target),exist_ok=True)
+            _copy(stored,target)
+            self.record(target,key)
+        return True
+
+    def save(self):
+        """ writes the index"""
+        if self.directory:
+            with self.lock:
+                data = json.dumps(self.index)
+            tmp = os.path.join(self.directory,'index.json.{0}'.format(os.getpid()))
+            with open(tmp,'w') as f:
+                f.write(data)
+            os.replace(tmp,os.path.join(self.directory,'index.json'))
+
+
+def get_store(directory):
+    """ the store in *directory*, shared by everybody in the process"""
+    if not directory:
+        return FigureStore()
+    with _stores_lock:
+        if not directory in _stores:
+            try:
+                os.makedirs(directory,exist_ok=True)
+            except OSError:
+                return FigureStore()
+            _stores[directory] = FigureStore(directory)
+        return _stores[directory]
+
+
+def store_of(options):
+    """ the store for the app options, in the cache directory if caching is
+    enabled"""
+    if options.get('cachedir') and not options.get('nocache'):
+        return get_store(os.path.join(options['cachedir'],'figures'))
+    return get_store(None)
+
+
+def get_pool(workers):
+    """ the pool of *workers* processes of this process, a forked copy of
+    us can't use the pool of its parent"""
+    key = (os.getpid(),workers)
+    with _pools_lock:
+        if not key in _pools:
+            _pools[key] = futures.ProcessPoolExecutor(workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        return _pools[key]
+
+
+def render(fig,simplify=False):
+    """ draws the figure with the Agg renderer, returns the canvas, with
+    *simplify* lines are simplified as much as possible"""
+    import matplotlib
+    if not hasattr(fig.canvas,'buffer_rgba'):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        FigureCanvasAgg(fig)
+    if simplify:
+        with matplotlib.rc_context({'path.simplify':True,
+                'path.simplify_threshold':1.0}):
+            fig.canvas.draw()
+    else:
+        fig.canvas.draw()
+    return fig.canvas
+
+
+class FigureWriter(object):
+    """ writes figures with a pool of *workers* processes, with no workers
+    they are written right away, *store* is the FigureStore to use"""
+
+    def __init__(self,workers,logger,store=None):
+        self.workers = workers
+        self.logger = logger
+        self.store = store or FigureStore()
+        self.pid = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        # the futures of a forked copy of us belong to its parent
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.futures = []
+        return get_pool(self.workers)
+
+    def save(self,fig,path,simplify=False):
+        """ draws the figure and writes it to *path* as png, if it isn't
+        there already, returns the digest of the figure"""
+        path = os.path.abspath(path)
+        canvas = render(fig,simplify)
+        renderer = canvas.get_renderer()
+        width,height = int(renderer.width),int(renderer.height)
+        key = cache.digest(canvas.buffer_rgba(),str(width),str(height),
+                str(fig.dpi))
+        if self.store.current(path,key):
+            self.logger.info('figure "{0}" is unchanged'.format(path))
+            return key
+        stored = self.store.get(key)
+        if stored:
+            _copy(stored,path)
+            self.store.record(path,key)
+            return key
+        storepath = self.store.path(key)
+        args = (width,height,fig.dpi,storepath or path,storepath and path)
+        if not self.workers:
+            _encode(canvas.buffer_rgba(),*args)
+            self.store.record(path,key)
+            return key
+        with self.lock:
+            future = self._pool().submit(_encode,bytes(canvas.buffer_rgba()),*args)
+            self.futures.append((future,key))
+        return key
+
+    def wait(self):
+        """ waits until all figures are written, returns False if writing
+        some of them failed"""
+        with self.lock:
+            pending,self.futures = self.futures,[]
+            if self.pid != os.getpid():
+                # they belong to the pool of our parent
+                pending = []
+        success = True
+        for future,key in pending:
+            try:
+                path = future.result()
+                self.store.record(path,key)
+                self.logger.info('wrote figure "{0}"'.format(path))
+            except Exception as e:
+                self.logger.error('couldn\'t write figure: {0}'.format(e))
+                success = False
+        try:
+            self.store.save()
+        except (IOError,OSError) as e:
+            self.logger.error('couldn\'t write figure index: {0}'.format(e))
+        return success
+
+    def close(self):
+        # the pool stays for the other projects
+        self.wait()
+        self.pid = None
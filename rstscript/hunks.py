@@ -92,13 +92,29 @@ class CodeIn(CodeBlock):
     pass
 
 
+class Cached(Node):
+    """ already formatted output of a chunk, taken from the cache"""
+    def __init__(self,parts):
+        self.parts = parts
+    @property
+    def formatted(self):
+        return ''.join(self.parts)
+    @property
+    def simple(self):
+        return ''.join(self.parts)
+
+
 class Figure(Node):
     template = ('\n.. _{self.label}:\n\n.. figure:: {self.path}\n\t:alt: {self.alt}\n\t:width: {self.width}'
             '\n\n\t{self.desc}\n')
     template2 = ('\n.. _{self.label}:\n\n.. figure:: {self.path}\n\t:alt: {self.alt}\n\t:width: {self.width}'
             '\n\t:height: {self.height}\n\n\t{self.desc}\n')
-    def __init__(self,path,label='',alt='',width='100%',height='100%',desc=''):
+    def __init__(self,path,label='',alt='',width='100%',height='100%',desc='',
+            target=None,key=None):
         self.path = path
+        #: the absolute path of the file and the digest of the figure
+        self.target = target
+        self.key = key
         self.label = label
         self.alt = alt
         self.width = width
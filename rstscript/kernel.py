@@ -9,17 +9,38 @@ import threading
 from rstscript import zmqserver
 from rstscript import daemonize
 from rstscript import litrunner
+from rstscript import workers as workerpool
 
 
 class ZmqHandler(zmqserver.MessageHandler,litrunner.LitServer):
 
-    def __init__(self,*args,**kwargs):
+    def __init__(self,memorybudget=0,spilldir=None,workers=0,preload=(),
+            **kwargs):
         super(ZmqHandler,self).__init__(**kwargs)
-        self.projects = {}
+        litrunner.LitServer.__init__(self,logging.getLogger('rstscript'),
+                memorybudget,spilldir)
+        # with workers the projects run in their processes, we only route
+        self.pool = None
+        if workers:
+            self.pool = workerpool.WorkerPool(workers,self.logger,memorybudget,
+                    spilldir,preload)
+        elif preload:
+            # don't keep the clients waiting meanwhile
+            threading.Thread(target=workerpool.preload,args=(preload,
+                self.logger,False),daemon=True).start()
 
     def run(self,socket,data,logger):
         # send some response by calling Litrunner.run method
-        socket.send_json(super(ZmqHandler,self).run(data,logger=logger))
+        if self.pool:
+            socket.send_json(self.pool.run(data,socket.send_json))
+        else:
+            socket.send_json(super(ZmqHandler,self).run(data,logger=logger))
+
+    def patch(self,socket,data,logger):
+        if self.pool:
+            socket.send_json(self.pool.run(data,socket.send_json))
+        else:
+            socket.send_json(super(ZmqHandler,self).patch(data,logger=logger))
 
 class RSTDaemon(daemonize.Daemon):
 
@@ -33,7 +54,11 @@ class RSTDaemon(daemonize.Daemon):
 
     def start(self):
         self.server = zmqserver.ZmqProcess(zmq.REP,host=self.host,
-                port=self.port,bind=True,Handler=ZmqHandler)
+                port=self.port,bind=True,Handler=ZmqHandler,
+                kwargs={'memorybudget':self.configs.get('memorybudget',0),
+                    'spilldir':self.configs.get('spilldir') or None,
+                    'workers':int(self.configs.get('workers',0) or 0),
+                    'preload':self.configs.get('preload') or []})
         signal.signal(signal.SIGINT,self.interupt)
         super().start()
 
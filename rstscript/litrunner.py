@@ -1,16 +1,31 @@
 import os
+import pickle
+import threading
 import collections
 import traceback
 import pprint
-import jinja2
 import textwrap
-from io import StringIO
 
+import rstscript
 from rstscript import hunks
 from rstscript import processors
+from rstscript import cache
+from rstscript import depgraph
+from rstscript import checkpoint
+from rstscript import scanner
+from rstscript import templates
+from rstscript import timing
+from rstscript import figures
 
 Chunk = collections.namedtuple('Chunk',
-        ['number','lineNumber', 'type','options','raw'])
+        ['number','lineNumber', 'type','options','raw','digest'])
+
+def tier(options):
+    """ the quality of the figures, drafts are cached separately"""
+    if options.get('draft',False):
+        return 'draft {0} {1}'.format(options.get('draftdpi',50),
+                bool(options.get('draftsimplify',False)))
+    return 'final'
 
 class Litrunner(object):
     """ Litrunner main Class
@@ -35,19 +50,34 @@ class Litrunner(object):
         self.logger = logger
         self.set_defaults()
         self.register_plugins()
-        self.woutput = StringIO()
-        self.toutput = StringIO()
-        # set up a memory of chunks
+        # set up a memory of chunks, with the woven and tangled output of
+        # every chunk, which are joined when the files are written
         self.chunks = []
-        self.dict = {'b':"test"}
+        # options and names of the chunks by digest, so unchanged chunks
+        # don't need to be parsed again
+        self.known = {}
+        self.names = {}
+        # the dependency graph of the last run
+        self.graph = None
+        # the index and a copy of the document of the last run
+        self.scanner = None
+        # persistent store of formatted chunks and the chunks we took from it
+        # without executing them
+        self.cache = cache.make_cache(self.options,self.logger)
+        self.skipped = []
+        # chunks whose state isn't in the processors, after a restore
+        self.stale = set()
+        # digest and stat of the files we wrote last
+        self.flushed = {}
+        # where the time of the last run went
+        self.report = timing.Report()
+        self.templates = templates.make_templates(self.options,self.logger)
+        # view on the namespaces of the processors for the templates
+        self.dict = collections.ChainMap({'b':"test"})
 
     def openfiles(self):
         try:
             self.input = open(self.options['input'],'r')
-            if self.options.get('toutput',''):
-                self.toutput.seek(0)
-            if not self.options.get('noweave',False):
-                self.woutput.seek(0)
             return True
         except Exception as e:
             self.logger.exception(e)
@@ -56,21 +86,85 @@ class Litrunner(object):
     def closefiles(self):
         try:
             self.input.close()
-            if self.options.get('toutput',''):
-                with open(self.options['toutput'],'w') as f:
-                    f.write(self.toutput.getvalue())
-            if not self.options.get('noweave',False):
-                with open(self.options['woutput'],'w') as f:
-                    f.write(self.woutput.getvalue())
+            with self.report.measure('flush'):
+                if self.options.get('toutput',''):
+                    self.flush(self.options['toutput'],self.tangled())
+                if not self.options.get('noweave',False):
+                    self.flush(self.options['woutput'],self.woven())
+            if self.options.get('report'):
+                self.report.write(self.options['report'])
             return True
         except Exception as e:
             self.logger.exception(e)
             return False
 
+    def ondisk(self,path):
+        """ digest of the content of a file, as long as nobody touched it
+        since we wrote it, it is not read again"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if path in self.flushed and self.flushed[path][1:] == (st.st_mtime_ns,st.st_size):
+            return self.flushed[path][0]
+        with open(path,'rb') as f:
+            return cache.digest(f.read())
+
+    def flush(self,path,text):
+        """ writes the text to the file if it changed, by renaming a
+        temporary file, so nobody sees a half written file"""
+        data = text.encode('utf-8')
+        digest = cache.digest(data)
+        if self.ondisk(path) == digest:
+            self.logger.info('"{0}" is unchanged'.format(path))
+            return False
+        tmp = os.path.join(os.path.dirname(os.path.abspath(path)),
+                '.{0}.{1}.{2}.tmp'.format(os.path.basename(path),os.getpid(),
+                    threading.get_ident()))
+        try:
+            with open(tmp,'wb') as f:
+                f.write(data)
+            if os.path.exists(path):
+                os.chmod(tmp,os.stat(path).st_mode & 0o7777)
+            os.replace(tmp,path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        st = os.stat(path)
+        self.flushed[path] = (digest,st.st_mtime_ns,st.st_size)
+        return True
+
+    def woven(self):
+        """ the woven document, with the timings of the chunks as comments
+        if the *annotate* option is set"""
+        if self.options.get('annotate',False):
+            return ''.join(''.join(chunk['woven'] or []) + self.report.comment(n)
+                    for n,chunk in enumerate(self.chunks))
+        return ''.join(''.join(chunk['woven'] or []) for chunk in self.chunks)
+
+    def tangled(self):
+        """ the tangled document"""
+        return ''.join(chunk['tangled'] for chunk in self.chunks)
+
+    def close(self):
+        """ stops the processes of the processors, if there are any"""
+        for processor in self.processors.values():
+            if hasattr(processor,'close'):
+                processor.close()
+        self.processors = {}
+        self.dict.maps[:] = self.dict.maps[-1:]
+
+    def wait(self):
+        """ waits for the processors to finish their background work"""
+        for processor in self.processors.values():
+            if hasattr(processor,'wait'):
+                processor.wait()
+
     def set_defaults(self):
         self.defaults = {'proc':'python','form':'compact'}
         if 'options' in self.options and self.options['options']:
-            self.defaults.update(self.options)
+            self.defaults.update(self.options['options'])
 
     def register_plugins(self):
         # register all loaded plugins, at least try it
@@ -93,13 +187,27 @@ class Litrunner(object):
         else:
             self.logger.error('formatter "{0}" already known'.format(FormatterClass.name))
 
-    def get_processor(self,name):
+    def get_processor(self,name,session=None):
+        """ returns the processor, chunks with a *session* option run in a
+        processor of their own in a separate process"""
         if name in self.processorClasses:
-            if not name in self.processors:
-                self.processors[name] = self.processorClasses[name](
-                        self.options,self.logger)
-                self.logger.info('instantiated processor "{0}"'.format(name))
-            return self.processors[name]
+            key = (name,session) if session else name
+            if not key in self.processors:
+                Processor = self.processorClasses[name]
+                forkable = Processor.forkable and hasattr(os,'fork')
+                if session and not forkable:
+                    self.logger.warn('processor "{0}" can\'t run in session '
+                            '"{1}", using the main one'.format(name,session))
+                    return self.get_processor(name)
+                if forkable and (session or self.options.get('checkpoints')):
+                    self.processors[key] = checkpoint.ForkedProcessor(
+                            Processor,self.options,self.logger)
+                else:
+                    self.processors[key] = Processor(self.options,self.logger)
+                if hasattr(self.processors[key],'dict'):
+                    self.dict.maps.insert(0,self.processors[key].dict)
+                self.logger.info('instantiated processor "{0}"'.format(key))
+            return self.processors[key]
         else:
             self.logger.error('there is no processor named "{0}",'
             'i will skip the chunk'.format(name))
@@ -115,168 +223,420 @@ class Litrunner(object):
             self.logger.error('there is no formatter named "{0}",'
             'i will skip the chunk'.format(name))
 
-    def read(self,fileobject,start='%<',end='%>',comment='%%'):
+    def seed(self):
+        """ digest of the project and the effective options, every chunk
+        digest starts with it"""
+        return cache.digest(rstscript.__version__,
+            self.options.get('input',''),self.options.get('woutput',''),
+            self.options.get('figdir',''),repr(sorted(self.defaults.items())),
+            tier(self.options))
+
+    def getoptions(self,line,linenumber):
+        try:
+            if line:
+                try:
+                    d = eval(line)
+                except:
+                    self.logger.error('couldn\'t evaluate options "{0}"'.format(line))
+                for key in self.defaults:
+                    d.setdefault(key,self.defaults[key])
+                self.logger.info(d)
+                return d
+            else:
+                return dict(self.defaults)
+        except Exception as e:
+            self.logger.warn('couldn\'t parse options {2} in line "{0}", "{1}"'
+                    .format(linenumber,e,repr(line.strip())))
+            return dict(self.defaults)
+
+    def materialize(self,entry):
+        """ builds the complete chunk of an entry of the scanner index"""
+        content = self.scanner.body(entry)
+        if entry.type == 'code':
+            line,newline,raw = content.partition('\n')
+            options = self.getoptions(line.strip(),entry.lineNumber)
+        else:
+            options = {}
+            raw = content
+        return Chunk(entry.number,entry.lineNumber,entry.type,options,raw,
+                entry.digest)
+
+    def chunkify(self,fileobject,start='%<',end='%>',comment='%%'):
         """This function returns a generator
-        It produces pieces from a fileobject, delimited with *chunk_start* and
-        *chunk_end* tokens.
+        It produces all pieces from a fileobject, delimited with *chunk_start*
+        and *chunk_end* tokens, the digest of the chunks is the digest of
+        their own content. Chunks we have seen before are not decoded again,
+        their ``raw`` is None, ``materialize`` their scanner entry to get it.
+        Without fileobject the document of the last run is used again, with
+        the edits of ``patch`` applied.
         """
+        if fileobject is not None:
+            self.scanner = scanner.Scanner(fileobject,start,end,comment)
+        known = {}
+        for entry in self.scanner.index:
+            if entry.digest in self.known:
+                chunk = Chunk(entry.number,entry.lineNumber,entry.type,
+                        self.known[entry.digest],None,entry.digest)
+            else:
+                chunk = self.materialize(entry)
+            known[entry.digest] = chunk.options
+            yield chunk
+        self.known = known
 
-        if len(start) != len(end) != len(comment):
-            raise RstscriptException('start end end tokens must have equal length')
-
-        #: holder of real content
-        content = StringIO()
-        #: counter for trvial error checking
-        delimtercounter = 0
-        #: informational counter
-        chunkn = 0
-        #: line number of chunk start
-        linecounter = 1
-        linen_of_chunkstart = linecounter
-        #: delimiter, and escaped delimiters
-        token_length = len(start)
-
-        def same(chunkn,content):
-            chunkhash = hash(content.getvalue())
-            if len(self.chunks) > chunkn and self.chunks[chunkn][0] == chunkhash:
-                return True
-            elif len(self.chunks) > chunkn:
-                self.chunks = self.chunks[:chunkn] # reset all further chunks
-                self.chunks.append([chunkhash,-1])
-                return False
+    def select(self,chunks):
+        """ returns the dependency graph of the chunks and the numbers of the
+        chunks which need to run, because they or chunks they depend on
+        changed since the last run"""
+        graph = depgraph.DependencyGraph(chunks,self.names,
+                self.templates.variables)
+        self.names = graph.known
+        changed = [chunk.number for chunk in chunks
+                if chunk.number >= len(self.chunks) or
+                self.chunks[chunk.number]['digest'] != chunk.digest]
+        # names the last version defined in changed or removed chunks
+        undefined = set()
+        if self.graph:
+            for number in changed + list(range(len(chunks),len(self.chunks))):
+                if number in self.graph.names:
+                    undefined |= self.graph.names[number].defined - (graph.names
+                            [number].defined if number in graph.names else set())
+        return graph,graph.select(changed,undefined)
+
+    def plan(self):
+        """ returns the numbers of the chunks the next run would execute,
+        without executing anything"""
+        last = self.scanner
+        with open(self.options['input'],'r') as f:
+            chunks = list(self.chunkify(f))
+            self.scanner.close()
+        self.scanner = last
+        graph,selected = self.select(chunks)
+        digests = graph.digests(self.seed())
+        run = set()
+        skipped = set()
+        for number in sorted(selected):
+            if self.cached(digests[number]) is not None:
+                skipped.add(number)
             else:
-                self.chunks.append([chunkhash,-1])
-                return False
+                replay = graph.ancestors(number) & skipped
+                skipped -= replay
+                run |= replay
+                run.add(number)
+        return sorted(run)
 
-        def buildchunk(number,linenumber,chunktype,content):
-            content.truncate()
-            content.seek(0)
-            # compare if something has changed, if nothing changed we can go on
-            if not same(number,content):
-                if chunktype == 'code': # write code
-                    options = getoptions(content.readline().strip(),linenumber)
-                    raw = content.read()
-                    self.toutput.write(raw)
+    def read(self,fileobject,start='%<',end='%>',comment='%%'):
+        """This function returns a generator
+        It produces the chunks which need to run from a fileobject, delimited
+        with *chunk_start* and *chunk_end* tokens.
+        """
+        with self.report.measure('read'):
+            chunks = list(self.chunkify(fileobject,start,end,comment))
+        with self.report.measure('read'):
+            self.graph,selected = self.select(chunks)
+        digests = self.graph.digests(self.seed())
+        # update the memory of chunks before yielding anything
+        self.chunks = [self.remember(chunk) if chunk.number in selected
+                else self.chunks[chunk.number] for chunk in chunks]
+        # chunks taken from the cache earlier, which changed since
+        self.skipped = [skipped for skipped in self.skipped
+                if skipped.number < len(chunks) and
+                digests[skipped.number] == skipped.digest]
+        for number in sorted(self.stale - selected):
+            if number < len(chunks) and chunks[number].type == 'code':
+                self.skipped.append(self.materialize(
+                    self.scanner.index[number])._replace(digest=digests[number]))
+        self.stale = set()
+        self.update_history(chunks,digests)
+        for chunk in chunks:
+            if chunk.number in selected:
+                if chunk.raw is None:
+                    chunk = self.materialize(self.scanner.index[chunk.number])
+                if chunk.type == 'code': # write code
+                    self.chunks[chunk.number]['tangled'] = chunk.raw
                 else: # write text commented
-                    options = {}
-                    raw = content.read()
-                    self.toutput.write(textwrap.indent(raw,'# '))
-                chunk = Chunk(number,linenumber,chunktype,options,raw)
-                content.seek(0)
+                    self.chunks[chunk.number]['tangled'] = textwrap.indent(
+                            chunk.raw,'# ')
+                chunk = chunk._replace(digest=digests[chunk.number])
                 self.logger.info('reading: {0}'.format(chunk))
                 yield chunk
             else:
-                content.seek(0)
-                self.logger.info('chunk "{0}" is unchanged'.format(number))
+                self.logger.info('chunk "{0}" is unchanged'.format(chunk.number))
 
-        def getoptions(line,linenumber):
-            try:
-                if line:
-                    try:
-                        d = eval(line)
-                    except:
-                        self.logger.error('couldn\'t evaluate options "{0}"'.format(line))
-                    for key in self.defaults:
-                        d.setdefault(key,self.defaults[key])
-                    self.logger.info(d)
-                    return d
+    def update_history(self,chunks,digests):
+        """ tells the forked processors which of their chunks the document
+        has now, so they don't replay chunks of an older version"""
+        for key,processor in self.processors.items():
+            if not hasattr(processor,'update'):
+                continue
+            history = {}
+            for chunk in chunks:
+                session = chunk.options.get('session')
+                if chunk.type != 'code' or key != ((chunk.options.get('proc'),
+                        session) if session else chunk.options.get('proc')):
+                    continue
+                old = processor.history.get(chunk.number)
+                if old is not None and old.digest == digests[chunk.number]:
+                    history[chunk.number] = old
                 else:
-                    return self.defaults
-            except Exception as e:
-                self.logger.warn('couldn\'t parse options {2} in line "{0}", "{1}"'
-                        .format(linenumber,e,repr(line.strip())))
-                return self.defaults
-
-        for line in fileobject:
-            line_start = line[:token_length]
-            # on start of chunk delimiter yield text
-            if line_start == start:
-                if content.tell() != 0:
-                    yield from buildchunk(chunkn,linen_of_chunkstart,'text',content)
-                    chunkn += 1
-                delimtercounter += 1
-                linen_of_chunkstart = linecounter
-                content.write(line[token_length:])
-            # on end of chunk delimiter yield code
-            elif line_start == end:
-                if content.tell() != 0:
-                    yield from buildchunk(chunkn,linen_of_chunkstart,'code',content)
-                    chunkn += 1
-                delimtercounter -= 1
-                linen_of_chunkstart = linecounter + 1
-            # remove the comment
-            elif line_start == comment:
-                content.write(line[token_length:])
-            else:
-                content.write(line)
+                    if chunk.raw is None:
+                        chunk = self.materialize(self.scanner.index[chunk.number])
+                    history[chunk.number] = chunk._replace(digest=digests[chunk.number])
+            processor.update(history)
 
-            # delimiter counter is 0 in text chunks and 1 in code chunks
-            # if it is smaller or bigger it must be an error
-            if delimtercounter > 1 or delimtercounter < 0:
-                msg = 'missing delimiter before line {}'
-                raise GeneratorExit(msg.format(linecounter))
+    def remember(self,chunk):
+        """ new memory of a chunk which runs again, the last rendering of a
+        text chunk is kept as long as the text is the same"""
+        memory = {'digest':chunk.digest,'woven':None,'tangled':''}
+        if (chunk.number < len(self.chunks) and
+                self.chunks[chunk.number]['digest'] == chunk.digest and
+                'rendered' in self.chunks[chunk.number]):
+            memory['rendered'] = self.chunks[chunk.number]['rendered']
+        return memory
 
-            linecounter += 1
+    def footprint(self):
+        """ approximate memory of the project in bytes, the outputs of the
+        chunks, the document and the namespaces of the processors"""
+        size = timing.sizeof([self.chunks,self.known,self.names])
+        if self.scanner:
+            size += len(self.scanner.buffer)
+        for processor in list(self.processors.values()):
+            if hasattr(processor,'dict'):
+                size += timing.sizeof(processor.dict,depth=2)
+        return size
 
-        if content.tell() != 0:
-            yield from buildchunk(chunkn,linen_of_chunkstart,'text',content)
+    def spill(self,path):
+        """ writes the chunk table and the document of the last run to
+        *path*, so ``restore`` can run the document again without executing
+        the unchanged chunks, the namespaces of the processors are lost"""
+        state = {'seed':self.seed(),'chunks':self.chunks,'known':self.known,
+                'names':self.names,'flushed':self.flushed,'scanner':self.scanner}
+        tmp = '{0}.{1}.tmp'.format(path,os.getpid())
+        with open(tmp,'wb') as f:
+            pickle.dump(state,f,pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp,path)
+
+    def restore(self,path):
+        """ takes the state written by ``spill`` and removes it, returns
+        False if there is none for the current options"""
+        try:
+            with open(path,'rb') as f:
+                state = pickle.load(f)
+            os.remove(path)
+        except (IOError,OSError,EOFError,pickle.UnpicklingError):
+            return False
+        if state['seed'] != self.seed():
+            return False
+        for key in ('chunks','known','names','flushed','scanner'):
+            setattr(self,key,state[key])
+        # the unchanged chunks need to be replayed before chunks depending
+        # on them are executed
+        self.stale = set(range(len(self.chunks)))
+        return True
+
+    @property
+    def version(self):
+        """ id of the version of the document of the last run"""
+        if self.scanner:
+            return self.scanner.version
+
+    def patch(self,delta):
+        """ applies an edit to the document of the last run
+
+        *delta* has the ``version`` the edit is based on and either an
+        unified ``diff`` or the lines ``first`` to ``last`` (counted from 1,
+        inclusive) which are replaced by ``text``. Returns False if the edit
+        couldn't be applied, then the document needs to be read again.
+        """
+        if not self.scanner or self.scanner.version != delta.get('version'):
+            self.logger.warn('unknown version "{0}" of the document, '
+                    'reading it again'.format(delta.get('version')))
+            return False
+        if 'diff' in delta:
+            replacements = scanner.parse_diff(delta['diff'])
+        else:
+            replacements = [(delta['first'],delta['last'],delta['text'])]
+        try:
+            for first,last,text in replacements:
+                n = self.scanner.replace(first,last,text)
+                self.logger.info('replaced lines {0} to {1}, scanned {2} chunks'
+                        ' again'.format(first,last,n))
+        except GeneratorExit as e:
+            self.logger.error('couldn\'t apply edit: {0}'.format(e))
+            return False
+        return True
+
+    def cached(self,digest,restore=False):
+        """ returns the cached formatted output of a chunk or None, also if
+        the figures of the chunk can't be put in place from the figure
+        store, with *restore* they are put in place"""
+        if self.cache and not self.options.get('rebuild',False):
+            entry = self.cache.get(digest)
+            if not isinstance(entry,dict):
+                return None
+            store = figures.store_of(self.options)
+            for target,key in entry['figures']:
+                try:
+                    if not store.restore(target,key,write=restore):
+                        return None
+                except (IOError,OSError) as e:
+                    self.logger.warn('couldn\'t restore figure "{0}": {1}'
+                            .format(target,e))
+                    return None
+            return entry['parts']
+
+    def replay(self,chunk):
+        """ executes the chunks the chunk depends on, which we took from the
+        cache, to get the state of the processors right before we execute it"""
+        if not self.skipped:
+            return
+        ancestors = self.graph.ancestors(chunk.number)
+        for skipped in self.skipped:
+            if skipped.type == 'code' and skipped.number in ancestors:
+                processor = self.get_processor(skipped.options['proc'],
+                        skipped.options.get('session'))
+                if processor:
+                    self.logger.info('replaying chunk "{0}"'.format(skipped.number))
+                    if hasattr(processor,'submit'):
+                        processor.submit(skipped,keep=False)
+                    else:
+                        for cchunk in processor.process(skipped):
+                            pass
+        self.skipped = [skipped for skipped in self.skipped
+                if not skipped.number in ancestors]
 
     def weave(self,chunks):
+        """ executes and renders the chunks, the chunks of sessions are only
+        submitted to their processes and we go on with the next chunks, but
+        the output is always in the order of the chunks"""
+        pending = collections.deque()
+        def drain():
+            while pending:
+                item = pending.popleft()
+                yield from item() if callable(item) else item
         for chunk in chunks:
+            processor = self.session(chunk)
+            if processor:
+                self.replay(chunk)
+                processor.submit(chunk)
+                pending.append(processor.result)
+                continue
+            if chunk.type == 'text':
+                # might use the variables of the sessions
+                yield from drain()
+            if pending:
+                pending.append(list(self.weave_chunk(chunk)))
+            else:
+                yield from self.weave_chunk(chunk)
+        yield from drain()
+
+    def session(self,chunk):
+        """ the processor of the session of a code chunk, None if it
+        doesn't run in a session or is in the cache"""
+        if (chunk.type == 'code' and chunk.options.get('session') and
+                self.cached(chunk.digest) is None):
+            processor = self.get_processor(chunk.options['proc'],
+                    chunk.options['session'])
+            if hasattr(processor,'submit'):
+                return processor
+
+    def weave_chunk(self,chunk):
+        formatted = self.cached(chunk.digest,restore=True)
+        if formatted is not None:
+            self.logger.info('chunk "{0}" taken from cache'.format(chunk.number))
+            self.skipped.append(chunk)
+            yield processors.CChunk(chunk,[hunks.Cached(formatted)])
+        else:
+            self.replay(chunk)
             if chunk.type == 'code':
-                processor = self.get_processor(chunk.options['proc'])
+                processor = self.get_processor(chunk.options['proc'],
+                        chunk.options.get('session'))
                 if processor:
                     for cchunk in processor.process(chunk):
-                        self.dict.update(processor.dict)
                         yield cchunk
                 else:
                     self.logger.warn('no processor named "{0}"'.
                             format(chunk.options['proc']))
             elif chunk.type == 'text':
-                temp = jinja2.Template(chunk.raw)
-                try:
-                    rendered = temp.render(self.dict)
-                except:
-                    self.logger.exception('failed to render chunk "{0}"'
-                            .format(chunk.number))
-                    rendered = chunk.raw
+                with self.report.measure('render',chunk.number):
+                    rendered = self.render(chunk)
                 yield processors.CChunk(chunk,[hunks.Text(rendered)])
             else:
                 self.logger.error('unsupported chunk type {0}'.
                         format(chunk.type))
 
+    def render(self,chunk):
+        """ renders a text chunk with the variables it uses, if their values
+        are the same as the last time, the last result is taken"""
+        variables = self.graph.variables.get(chunk.number,())
+        fingerprint = templates.fingerprint(self.dict,variables)
+        memory = {}
+        if chunk.number < len(self.chunks):
+            memory = self.chunks[chunk.number]
+        if fingerprint and memory.get('rendered',(None,))[0] == fingerprint:
+            self.logger.info('variables of chunk "{0}" are unchanged'
+                    .format(chunk.number))
+            return memory['rendered'][1]
+        try:
+            rendered = self.templates.render(chunk.raw,dict((name,self.dict[name])
+                for name in variables if name in self.dict))
+        except:
+            self.logger.exception('failed to render chunk "{0}"'
+                    .format(chunk.number))
+            return chunk.raw
+        memory['rendered'] = (fingerprint,rendered)
+        return rendered
+
+    def store(self,cchunk,formatted):
+        # don't keep failures, they often depend on things outside the document
+        if self.cache and not any(type(hunk) == hunks.CodeTraceback
+                for hunk in cchunk.hunks):
+            self.cache.set(cchunk.chunk.digest,{'parts':formatted,
+                'figures':[[hunk.target,hunk.key] for hunk in cchunk.hunks
+                    if type(hunk) == hunks.Figure and hunk.key]})
+
     def format(self,cchunks):
         for cchunk in cchunks:
-            if cchunk.chunk.type == 'code':
+            if cchunk.hunks and type(cchunk.hunks[0]) == hunks.Cached:
+                yield cchunk.chunk.number,cchunk.hunks[0].parts
+            elif cchunk.chunk.type == 'code':
                 formatter = self.get_formatter(cchunk.chunk.options['form'])
                 if formatter:
-                    yield from formatter(cchunk)
+                    with self.report.measure('format',cchunk.chunk.number):
+                        outputs = list(formatter(cchunk))
+                    for chunkn,formatted in outputs:
+                        self.store(cchunk,formatted)
+                        yield chunkn,formatted
                 else:
                     self.logger.warn('no formatter named "{0}"'.
                             format(cchunk.chunk.options['form']))
             elif cchunk.chunk.type == 'text':
-                yield cchunk.chunk.number,[cchunk.hunks[0].formatted]
+                formatted = [cchunk.hunks[0].formatted]
+                self.store(cchunk,formatted)
+                yield cchunk.chunk.number,formatted
             else:
                 self.logger.error('unsupported chunk type {0}'.
                         format(chunk.type))
 
-    def run(self):
+    def run(self,delta=None):
+        # with an edit we don't need to read the input again
+        patched = bool(delta) and self.patch(delta)
         if self.openfiles():
             try:
                 self.logger.info('Run Litrunner with options "{0}"'.
                         format(pprint.pformat(self.options)))
 
+                self.report = timing.Report()
                 if not self.options.get('noweave',False):
-                    for chunkn,formatted in self.format(self.weave(self.read(self.input))):
-                        if chunkn > 0 and self.chunks[chunkn-1][1] > 0:
-                            self.woutput.seek(self.chunks[chunkn-1][1])
-                        for hunk in formatted:
-                            self.woutput.write(hunk)
-                            self.chunks[chunkn][1] = self.woutput.tell()
-                    if self.woutput.tell():
-                        self.woutput.truncate()
+                    chunks = self.read(None if patched else self.input)
+                    for chunkn,formatted in self.format(self.weave(chunks)):
+                        self.chunks[chunkn]['woven'] = formatted
+                    with self.report.measure('figures'):
+                        self.wait()
+                    for processor in self.processors.values():
+                        if hasattr(processor,'report'):
+                            self.report.merge(processor.report.take())
                 elif self.options.get('noweave',False) and self.options.get('toutput',''):
-                    for formatted in self.read(self.input):
+                    for formatted in self.read(None if patched else self.input):
                         pass
                 else:
                     self.logger.warn('no job specified, don\'t do anything')
@@ -292,9 +652,95 @@ class Litrunner(object):
 
 
 class LitServer(object):
-    def __init__(self,logger):
-        self.projects = {}
+    """ keeps the projects of the daemon, with a *memorybudget* in MB the
+    least recently used projects are evicted when all of them together
+    need more, with a *spilldir* their chunk tables are kept there, so they
+    don't need to run all again"""
+
+    def __init__(self,logger,memorybudget=0,spilldir=None):
+        self.projects = collections.OrderedDict()
         self.logger = logger
+        self.budget = int(float(memorybudget or 0)*1024*1024)
+        self.spilldir = spilldir
+        if spilldir and not os.path.exists(spilldir):
+            os.makedirs(spilldir)
+        # approximate memory of the projects after their last run
+        self.sizes = {}
+        # number of runs of a project right now, they can't be evicted
+        self.active = collections.Counter()
+        # replaced projects, which are closed when the runs are done
+        self.closing = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def spillpath(self,project_id):
+        return os.path.join(self.spilldir,cache.digest(repr(project_id)) + '.pickle')
+
+    def activate(self,project_id,data,logger):
+        """ returns the project, new if needed, and marks it as running"""
+        with self.lock:
+            project = self.projects.get(project_id)
+            # test if default options or the figure quality changed
+            if (project and not data.get('rebuild',False) and
+                    project.options['options'] == data['options'] and
+                    tier(project.options) == tier(data)):
+                # the logger needs to be renewed, has info from old thread
+                # and so on
+                project.logger = logger
+            else:
+                if project and project_id in self.active:
+                    # it still runs in another thread
+                    self.closing[project_id].append(project)
+                elif project:
+                    project.close()
+                project = Litrunner(data,logger)
+                if (self.spilldir and not data.get('rebuild',False) and
+                        project.restore(self.spillpath(project_id))):
+                    logger.info('restored project "{0}"'.format(project_id[0]))
+                self.projects[project_id] = project
+            self.projects.move_to_end(project_id)
+            self.active[project_id] += 1
+            return project
+
+    def release(self,project_id,project):
+        """ marks the project as done, closes the projects it replaced if
+        nothing runs anymore and evicts projects if we are over the
+        budget"""
+        size = project.footprint() if self.budget else 0
+        replaced = []
+        with self.lock:
+            self.active[project_id] -= 1
+            if not self.active[project_id]:
+                del self.active[project_id]
+                replaced = self.closing.pop(project_id,[])
+            if self.projects.get(project_id) is project:
+                self.sizes[project_id] = size
+            self.evict(keep=project_id)
+        for project in replaced:
+            project.close()
+
+    def evict(self,keep=None):
+        """ evicts the least recently used projects, which aren't running,
+        until the rest fits into the budget, *keep* stays anyway"""
+        if not self.budget:
+            return
+        total = sum(self.sizes.get(project_id,0) for project_id in self.projects)
+        for project_id in list(self.projects):
+            if total <= self.budget:
+                break
+            if project_id in self.active or project_id == keep:
+                continue
+            self.logger.warn('evicting project "{0}", the projects need {1}KB'
+                    .format(project_id[0],total//1024))
+            project = self.projects.pop(project_id)
+            total -= self.sizes.pop(project_id,0)
+            try:
+                if self.spilldir:
+                    project.spill(self.spillpath(project_id))
+            except Exception as e:
+                self.logger.error('couldn\'t spill project "{0}": {1}'
+                        .format(project_id[0],e))
+            finally:
+                project.close()
 
     def run(self,data,logger=None):
         if not logger:
@@ -306,21 +752,26 @@ class LitServer(object):
             logger.error('there needs to be at least the "input" key in the data')
         # do the work
         try:
-            if project_id in self.projects and not data.get('rebuild',False):
-                # test if default options changed
-                if self.projects[project_id].options['options'] != data['options']:
-                    self.projects[project_id] = Litrunner(data,logger)
-                else:
-                    # the logger needs to be renewed, has info from old thread
-                    # and so on
-                    self.projects[project_id].logger = logger
-            else:
-                # completely new
-                self.projects[project_id] = Litrunner(data,logger)
+            project = self.activate(project_id,data,logger)
+        except Exception:
+            logger.exception('an unexpected error occured')
+            return ['done',{}]
+        try:
+            if data.get('plan',False):
+                return ['done',{'plan':project.plan()}]
             # now run the project
-            self.projects[project_id].run()
+            project.run(delta=data.get('delta'))
+            result = {'version':project.version}
+            if data.get('timings',False):
+                result['timings'] = project.report.table()
+            return ['done',result]
         except Exception:
             logger.exception('an unexpected error occured')
         finally:
-            pass
+            self.release(project_id,project)
         return ['done',{}]
+
+    def patch(self,data,logger=None):
+        """ like run, but the data has a ``delta`` with an edit of the
+        document of the last run, see ``Litrunner.patch``"""
+        return LitServer.run(self,data,logger=logger)
@@ -0,0 +1,331 @@
+import os
+import glob
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import zmq
+
+import rstscript
+from rstscript import kernel
+from rstscript import benchmark
+from rstscript import editbench
+
+"""
+Load test of the daemon.
+
+The daemon is started in the foreground in a process of its own, on a free
+local port, and driven by concurrent clients, which speak the protocol of
+``client.Client``. Every client works on one of the projects, like an editor
+which runs its document again and again, optionally with an edit before
+every run. Edits are saved like most editors do, to a new file which replaces
+the document, with ``--in-place`` the document is overwritten instead. The
+throughput, the latency of the runs and, sampled over time, the threads and
+the resident memory of the daemon and its workers are reported.
+
+    python -m rstscript.loadtest --clients 8 --projects 4 --requests 50
+"""
+
+
+def serve(host,port,pidfile,workers=0,preload=()):
+    """ runs the daemon in the foreground until it is stopped"""
+    daemon = kernel.RSTDaemon({'pidfile':pidfile,'host':host,'port':port,
+        'foreground':True,'workers':workers,'preload':list(preload)})
+    daemon.start()
+    daemon.server.join()
+
+
+def free_port(host):
+    sock = socket.socket()
+    try:
+        sock.bind((host,0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def process_stats(pid):
+    """ number of threads and resident memory in KB of the process, None
+    where we can't find out"""
+    try:
+        with open('/proc/{0}/status'.format(pid),'r') as f:
+            fields = dict(line.split(':',1) for line in f if ':' in line)
+        return int(fields['Threads']),int(fields['VmRSS'].split()[0])
+    except (IOError,OSError,KeyError,ValueError):
+        return None,None
+
+
+def children(pid):
+    """ the pids of the children of the process, started by any of its
+    threads"""
+    result = []
+    for path in glob.glob('/proc/{0}/task/*/children'.format(pid)):
+        try:
+            with open(path,'r') as f:
+                result.extend(int(child) for child in f.read().split())
+        except (IOError,OSError,ValueError):
+            pass
+    return result
+
+
+def tree_stats(pid):
+    """ like ``process_stats``, for the process and all its descendants
+    together"""
+    threads,rss = process_stats(pid)
+    for child in children(pid):
+        t,r = tree_stats(child)
+        if threads is not None and t is not None:
+            threads,rss = threads + t,rss + r
+    return threads,rss
+
+
+class SimulatedClient(object):
+    """ sends jobs to the daemon like ``client.Client``, but blocking and
+    without printing anything, so many of them can run in threads"""
+
+    def __init__(self,context,host,port,timeout=60,alive=None):
+        self.host = host
+        self.timeout = timeout
+        self.alive = alive
+        self.answer_sock = context.socket(zmq.REQ)
+        self.answer_sock.setsockopt(zmq.LINGER,0)
+        self.answer_sock.connect('tcp://{0}:{1}'.format(host,port))
+        self.pull_sock = context.socket(zmq.PULL)
+        self.pull_sock.setsockopt(zmq.LINGER,0)
+        self.pull_port = self.pull_sock.bind_to_random_port('tcp://{0}'.format(host))
+        self.version = None
+
+    def _recv(self,sock):
+        deadline = time.time() + self.timeout
+        while not sock.poll(100):
+            if time.time() > deadline or (self.alive and not self.alive()):
+                raise rstscript.RstscriptException('no answer from the daemon')
+        return sock.recv_json()
+
+    def ping(self):
+        self.answer_sock.send_json(['ping',{}])
+        return self._recv(self.answer_sock)[0] == 'alive'
+
+    def stop(self):
+        self.answer_sock.send_json(['stop',{}])
+        return self._recv(self.answer_sock)[0] == 'alive'
+
+    def run(self,data,msg_type='run'):
+        """ sends a job and waits until it is done, returns the data of the
+        done message and the log messages"""
+        data = dict(data,host=self.host,port=self.pull_port)
+        self.answer_sock.send_json([msg_type,data])
+        if self._recv(self.answer_sock)[0] != 'done':
+            raise rstscript.RstscriptException('the daemon refused the job')
+        logs = []
+        while True:
+            msg = self._recv(self.pull_sock)
+            if msg[0] == 'done':
+                self.version = msg[1].get('version')
+                return msg[1],logs
+            logs.append(msg[1])
+
+    def close(self):
+        self.answer_sock.close()
+        self.pull_sock.close()
+
+
+class Project(object):
+    """ a generated document and the data a client sends for it"""
+
+    def __init__(self,directory,chunks,inplace=False,figures=0):
+        self.inplace = inplace
+        self.lines,self.editable = editbench.synthetic(chunks,figures=figures)
+        self.edits = 0
+        self.lock = threading.Lock()
+        self.data = {'input':os.path.join(directory,'document.nw'),
+                'woutput':os.path.join(directory,'document.rst'),
+                'toutput':None,'figdir':os.path.join(directory,'_figures'),
+                'options':{},'loglevel':'ERROR','figureworkers':0}
+        os.makedirs(directory)
+        self.write()
+
+    def write(self):
+        path = self.data['input']
+        if not self.inplace:
+            path = '{0}.tmp'.format(path)
+        with open(path,'w') as f:
+            f.write(''.join(self.lines))
+        if not self.inplace:
+            os.replace(path,self.data['input'])
+
+    def edit(self):
+        """ changes the code chunk in the middle of the document"""
+        with self.lock:
+            self.edits += 1
+            index,make = self.editable[('code','middle')]
+            self.lines[index] = make(self.edits + 1)
+            self.write()
+
+
+def wait_alive(context,host,port,timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        c = SimulatedClient(context,host,port,timeout=1)
+        try:
+            if c.ping():
+                return True
+        except rstscript.RstscriptException:
+            pass
+        finally:
+            c.close()
+    return False
+
+
+def run(clients=4,projects=2,requests=20,chunks=50,edit=False,interval=0.5,
+        host='127.0.0.1',inplace=False,workers=0,preload=()):
+    """ starts a daemon and lets *clients* clients send *requests* jobs
+    each, for *projects* generated documents of *chunks* chunks, returns the
+    results as dict"""
+    tmpdir = tempfile.mkdtemp()
+    port = free_port(host)
+    mp = multiprocessing.get_context('spawn')
+    daemon = mp.Process(target=serve,args=(host,port,
+        os.path.join(tmpdir,'rstscript.pid'),workers,preload))
+    daemon.start()
+    context = zmq.Context()
+    try:
+        if not wait_alive(context,host,port):
+            raise rstscript.RstscriptException('the daemon didn\'t start')
+        docs = [Project(os.path.join(tmpdir,'project{0}'.format(i)),chunks,
+            inplace) for i in range(projects)]
+        latencies = []
+        errors = []
+        samples = []
+        finished = threading.Event()
+
+        def client(number):
+            c = SimulatedClient(context,host,port,alive=daemon.is_alive)
+            project = docs[number % len(docs)]
+            try:
+                for i in range(requests):
+                    if edit:
+                        project.edit()
+                    t = time.perf_counter()
+                    result,logs = c.run(project.data)
+                    latencies.append(time.perf_counter() - t)
+                    if 'version' not in result:
+                        errors.append('\n'.join(logs) or 'job failed')
+            except Exception as e:
+                errors.append(str(e))
+            finally:
+                c.close()
+
+        def sample():
+            while True:
+                threads,rss = tree_stats(daemon.pid)
+                samples.append({'time':time.perf_counter() - start,
+                    'threads':threads,'rss':rss,'done':len(latencies)})
+                if not daemon.is_alive() or finished.wait(interval):
+                    break
+
+        start = time.perf_counter()
+        sampler = threading.Thread(target=sample,daemon=True)
+        sampler.start()
+        workers = [threading.Thread(target=client,args=(i,),daemon=True)
+                for i in range(clients)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+        finished.set()
+        sampler.join()
+        if not daemon.is_alive():
+            errors.insert(0,'the daemon died with exit code {0}'
+                    .format(daemon.exitcode))
+        results = {'clients':clients,'projects':projects,
+                'requests':len(latencies),'errors':errors,'seconds':seconds,
+                'throughput':len(latencies)/seconds if seconds else 0,
+                'samples':samples}
+        if latencies:
+            results['latency'] = editbench.percentiles(latencies)
+        return results
+    finally:
+        stopper = SimulatedClient(context,host,port,timeout=5,
+                alive=daemon.is_alive)
+        try:
+            stopper.stop()
+        except rstscript.RstscriptException:
+            pass
+        finally:
+            stopper.close()
+        daemon.join(10)
+        if daemon.is_alive():
+            daemon.terminate()
+            daemon.join()
+        context.term()
+        shutil.rmtree(tmpdir)
+
+
+def table(results):
+    lines = ['{0[clients]} clients, {0[projects]} projects, {0[requests]} runs '
+            'in {0[seconds]:.2f}s, {0[throughput]:.1f} runs/s, {1} errors'
+            .format(results,len(results['errors']))]
+    if 'latency' in results:
+        lines.append('latency p50 {0[p50]:.4f}s p90 {0[p90]:.4f}s p99 {0[p99]:.4f}s '
+                'max {0[max]:.4f}s'.format(results['latency']))
+    lines.append('')
+    lines.append('{0:>8}{1:>10}{2:>12}{3:>8}'.format('time','threads','rss','runs'))
+    for s in results['samples']:
+        lines.append('{0:>7.1f}s{1:>10}{2:>10}KB{3:>8}'.format(s['time'],
+            s['threads'] if s['threads'] is not None else '?',
+            s['rss'] if s['rss'] is not None else '?',s['done']))
+    for error in results['errors'][:5]:
+        lines.append('error: {0}'.format(error))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='load test of the daemon')
+    parser.add_argument('--clients',type=int,default=4,
+            help='number of concurrent clients')
+    parser.add_argument('--projects',type=int,default=2,
+            help='number of projects the clients work on')
+    parser.add_argument('--requests',type=int,default=20,
+            help='number of runs every client requests')
+    parser.add_argument('--chunks',type=int,default=50,
+            help='number of text and code chunk pairs of every project')
+    parser.add_argument('--edit',action='store_true',default=False,
+            help='edit the document before every run')
+    parser.add_argument('--in-place',dest='inplace',action='store_true',
+            default=False,help='overwrite the documents when editing them, '
+            'instead of replacing them')
+    parser.add_argument('--workers',type=int,default=0,
+            help='number of worker processes of the daemon, 0 runs the '
+            'projects in threads')
+    parser.add_argument('--preload',nargs='*',default=[],
+            help='modules the daemon imports before the projects run')
+    parser.add_argument('--interval',type=float,default=0.5,
+            help='seconds between the samples of the daemon process')
+    parser.add_argument('--host',default='127.0.0.1',
+            help='local address the daemon listens on')
+    parser.add_argument('--history',default=os.path.join('performance','history.json'),
+            help='json file with the results of earlier runs')
+    parser.add_argument('--no-history',dest='nohistory',action='store_true',
+            default=False,help='don\'t write the results to the history')
+    args = parser.parse_args(argv)
+    results = run(args.clients,args.projects,args.requests,args.chunks,
+            args.edit,args.interval,args.host,args.inplace,args.workers,
+            args.preload)
+    print(table(results))
+    if not args.nohistory:
+        name = 'load:{0}x{1}-{2}{3}'.format(args.clients,args.projects,
+                args.chunks,':edit' if args.edit else '')
+        summary = dict((k,v) for k,v in results.items() if k != 'samples')
+        benchmark.record(args.history,benchmark.load_history(args.history),
+                {name:summary})
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
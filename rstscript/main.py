@@ -46,6 +46,8 @@ def make_server_parser():
 
 def make_client_parser():
     default_configdir = os.path.join(os.getenv("XDG_CONFIG_HOME",''),"rstscript")
+    default_cachedir = os.path.join(os.getenv("XDG_CACHE_HOME",
+        os.path.expanduser('~/.cache')),"rstscript")
     pre_parser = argparse.ArgumentParser(add_help=False)
     pre_parser.add_argument("-c", "--conf", dest="conf",
             default=os.path.join(default_configdir,'config.json'),
@@ -66,12 +68,62 @@ def make_client_parser():
     parser.add_argument('--plugindir',action='store',
             default=os.path.join(default_configdir,'plugins'),
             help='specify the plugin directory')
+    parser.add_argument("--cache-directory", dest='cachedir',
+                    action="store", default=default_cachedir,
+                    help="path to store the cached output of chunks")
+    parser.add_argument("--cache-size", dest='cachesize', type=int,
+                    action="store", default=100,
+                    help="size budget of the cache in MB")
+    parser.add_argument('--no-cache',action='store_true', default=False,
+            dest='nocache', help='don\'t use the persistent chunk cache')
+    parser.add_argument("--checkpoints", dest='checkpoints', type=int,
+                    action="store", default=0,
+                    help="execute in a child process and keep a snapshot of it "
+                    "every N chunks, 0 executes in the process itself")
+    parser.add_argument("--checkpoint-memory", dest='checkpointmemory', type=int,
+                    action="store", default=0,
+                    help="memory budget of all snapshots in MB, 0 is unlimited")
+
+    parser.add_argument("--subinterpreters", action="store_true", default=False,
+            help="execute the python chunks in a subinterpreter of the "
+            "project with its own GIL, where python supports it, without "
+            "checkpoints")
+
+    parser.add_argument("--figure-workers", dest='figureworkers', type=int,
+                    action="store", default=0,
+                    help="number of processes writing the figures in the "
+                    "background, shared by all projects, 0 writes them right "
+                    "away")
+
+    parser.add_argument("--draft", action="store_true", default=False,
+            help="render the figures in draft quality, for previews")
+    parser.add_argument("--draft-dpi", dest='draftdpi', type=int,
+                    action="store", default=50,
+                    help="resolution of the figures in draft quality")
+    parser.add_argument("--draft-simplify", dest='draftsimplify',
+            action="store_true", default=False,
+            help="simplify the lines of figures in draft quality")
+
+    parser.add_argument("--report", dest='report', default=None,
+            help="write the timings of the chunks and phases as json to this file")
+    parser.add_argument("--timings", action="store_true", default=False,
+            help="print a summary of the timings")
+    parser.add_argument("--annotate-timings", dest='annotate',
+            action="store_true", default=False,
+            help="add the timings of the chunks as comments to the woven output")
 
     parser.add_argument("--ipython-connection",default=None, nargs='?',
             help="connect to running ipython kernel")
 
     parser.add_argument("-r", "--rebuild", action="store_true", default=False,
             help="force a rebuild of the project although it might be already stored")
+    parser.add_argument("--plan", action="store_true", default=False,
+            help="only print which chunks would be executed")
+    parser.add_argument("--diff", dest='diff', default=None,
+            help="send only this unified diff against the version of the "
+            "document the daemon saw last")
+    parser.add_argument("--version-id", dest='versionid', default=None,
+            help="the version the diff is based on, printed by the last run")
     parser.add_argument("-d", "--debug", action="store_true", default=False,
             help="run in debugging mode, equivalent to -l debug")
     parser.add_argument('-q','--quiet',dest='quiet',action='store_true', default=False,
@@ -193,6 +245,20 @@ def run_locally(options):
 
 
 
+def process_locally(configs):
+    """ runs the document without the daemon, or only prints the plan,
+    the report of the run is written and printed like the options say"""
+    L = run_locally(configs)
+    if configs.get('plan'):
+        print('chunks to run',L.plan())
+        return L
+    # writes the report too
+    L.run()
+    if configs.get('timings'):
+        print(L.report.table())
+    return L
+
+
 def client_main(argv=None):
     # read deafult configs
     configs = yaml.load(pkgutil.get_data(__name__,'defaults/config.yml').decode('utf-8'))
@@ -223,7 +289,7 @@ def client_main(argv=None):
     # add the source directory to the config
     configs['rootdir'] = os.path.abspath('.')
     # make the file paths absolute
-    for x in ('input','woutput','toutput'):
+    for x in ('input','woutput','toutput','cachedir','report'):
         if configs[x] and not os.path.isabs(configs[x]) :
             configs[x] = os.path.join(configs['rootdir'],configs[x])
     # make the figdir absolute to the weaveing output if not already absolute
@@ -249,11 +315,16 @@ def client_main(argv=None):
 
         # Send the data
         t1 = time.time()
-        mclient.run(configs)
+        if configs['diff']:
+            with open(configs['diff'],'r') as f:
+                mclient.patch(configs,{'version':configs['versionid'],
+                    'diff':f.read()})
+        else:
+            mclient.run(configs)
         print('elapsed time',time.time()-t1)
 
         mclient.close()
     else: # process locally
-        return run_locally(configs)
+        return process_locally(configs)
 
 
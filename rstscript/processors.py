@@ -8,6 +8,11 @@ import collections
 
 import rstscript
 from rstscript import hunks
+from rstscript import cache
+from rstscript import timing
+from rstscript import capture
+from rstscript import figures
+from rstscript import subinterpreters
 
 CChunk = collections.namedtuple('CChunk',['chunk','hunks'])
 
@@ -46,20 +51,20 @@ class PluginBase(metaclass=abc.ABCMeta):
 class LitVisitor(ast.NodeTransformer):
     """ special ast visitor, parses code chunks from string into single code
     objects do not set maxdepth bigger than 1, except you know what you do, but
-    probaly the compilation will fail"""
+    probaly the compilation will fail
 
-    def __init__(self,inputfilename,logger,maxdepth=1):
+    The compiled statements of a chunk are kept in the *compiled* cache, see
+    ``statements``.
+    """
+
+    def __init__(self,inputfilename,logger,maxdepth=1,compiled=None):
         self.maxdepth = maxdepth
         self.inputfilename = inputfilename
         self.logger = logger
-        self.CodeChunk = collections.namedtuple('CodeChunk',['codeobject','source','assign'])
-
-    def _get_last_lineno(self,node):
-        maxlineno = 0
-        for x in ast.walk(node):
-            if hasattr(x,'lineno') and x.lineno > maxlineno:
-                maxlineno = x.lineno
-        return maxlineno
+        self.compiled = compiled
+        # modules are the imported modules of import statements
+        self.CodeChunk = collections.namedtuple('CodeChunk',
+                ['codeobject','source','assign','modules'],defaults=[None])
 
     def _autoprint(self,node):
         # implement autoprinting discovery
@@ -67,7 +72,7 @@ class LitVisitor(ast.NodeTransformer):
             # test if simple assignement or trough some expression
             bmc = []
             for x in ast.iter_child_nodes(node):
-                if not type(x) in (ast.Name,ast.Num,ast.Str):
+                if not type(x) in (ast.Name,ast.Constant):
                     bmc.append(x)
             if len(bmc)>0:
                 if hasattr(node.targets[0],'id'):
@@ -77,13 +82,13 @@ class LitVisitor(ast.NodeTransformer):
 
     def _compile(self,node):
         # fix linenumber, so it represents linenumber of original file
-        codeobject = compile(ast.Module([node]),"{0}".format(self.inputfilename),'exec')
+        codeobject = compile(ast.Module(body=[node],type_ignores=[]),"{0}".format(self.inputfilename),'exec')
         #source = meta.asttools.dump_python_source(node)
         auto = self._autoprint(node)
         return self.CodeChunk(codeobject,node.source,auto)
 
-    def _detect_matplotlib(self,node):
-        for modpart in node.module.split('.'):
+    def _detect_matplotlib(self,modules):
+        for modpart in '.'.join(modules).split('.'):
             if modpart in ['pyplot','pylab','sympy']:
                 if not 'matplotlib.pyplot' in sys.modules:
                     self.logger.info('detected "{0}" and imported matplotlib'
@@ -96,17 +101,31 @@ class LitVisitor(ast.NodeTransformer):
                     'but backend was already choosen')
 
     def visit_Import(self,node):
-        newnode = self._detect_matplotlib(node)
-        if newnode:
-            yield newnode
-        yield self._compile(node)
-
+        yield self._compile(node)._replace(
+                modules=[alias.name for alias in node.names])
 
     def visit_ImportFrom(self,node):
-        newnode = self._detect_matplotlib(node)
-        if newnode:
-            yield newnode
-        yield self._compile(node)
+        yield self._compile(node)._replace(modules=[node.module or ''])
+
+    def statements(self,raw,start_lineno):
+        """ generates the compiled statements of the source of a chunk,
+        which starts at line *start_lineno*, the source is only parsed and
+        compiled if it isn't in the cache"""
+        key = cache.digest(sys.version,str(self.inputfilename),
+                str(start_lineno),raw)
+        compiled = self.compiled.get(key) if self.compiled else None
+        if compiled is None:
+            compiled = list(self.visit(ast.parse(raw),start_lineno,raw.splitlines()))
+            if self.compiled:
+                self.compiled.set(key,[tuple(c) for c in compiled])
+        for codechunk in compiled:
+            codechunk = self.CodeChunk(*codechunk)
+            # matplotlib might have been imported meanwhile
+            if codechunk.modules:
+                newnode = self._detect_matplotlib(codechunk.modules)
+                if newnode:
+                    yield newnode
+            yield codechunk
 
     def visit(self, node, start_lineno,raw,depth=0):
         """Visit a node."""
@@ -115,10 +134,9 @@ class LitVisitor(ast.NodeTransformer):
             visitor = getattr(self, method, None)
             # get source code of the node, must be before the next statement
             startline = node.lineno-1
-            endline = self._get_last_lineno(node)
+            endline = node.end_lineno
             node.source = '\n'.join(raw[startline:endline])
-            #print('last line',self._get_last_lineno(node),'source',node.source)
-            node.lineno = node.lineno + start_lineno
+            ast.increment_lineno(node,start_lineno)
             if visitor:
                 yield from visitor(node)
             else:
@@ -131,6 +149,8 @@ class LitVisitor(ast.NodeTransformer):
 class BaseProcessor(PluginBase):
     plugtype = 'processor'
     plugins = {}
+    #: if it can run in a forked process, see :mod:`rstscript.checkpoint`
+    forkable = False
 
     def __init__(self,appoptions,logger):
         self.options = appoptions
@@ -146,20 +166,22 @@ class NoneProcessore(BaseProcessor):
 class PythonProcessor(BaseProcessor):
     name = 'python'
     defaults = {'af':False}
+    forkable = True
 
     def __init__(self,appoptions,logger):
         super().__init__(appoptions,logger)
         self.globallocal = {}
         self.stderr = io.StringIO()
         self.stdout = io.StringIO()
-        self.traceback = io.StringIO()
-        self.stdout_sys = sys.stdout
-        self.stderr_sys = sys.stderr
         self.inputfilename = appoptions.get('input','')
-        self.visitor = LitVisitor(self.inputfilename,logger=self.logger)
+        self.visitor = LitVisitor(self.inputfilename,logger=self.logger,
+                compiled=cache.make_compile_cache(appoptions))
         self.plt = False
         self.init = True
         self.dict = self.globallocal # just to have some freedom in future, let dict be interface
+        self.report = timing.Report()
+        self.figures = figures.FigureWriter(int(appoptions.get('figureworkers',0)),
+                self.logger,figures.store_of(appoptions))
         if appoptions.get('ipython_connection'):
             try:
                 from .interactive import IPythonConnection
@@ -174,6 +196,19 @@ class PythonProcessor(BaseProcessor):
 
         else:
             self.ipc = None
+        self.interpreter = None
+        # the snapshots are forks, which subinterpreters don't survive
+        if appoptions.get('subinterpreters') and not appoptions.get('checkpoints'):
+            self.interpreter = subinterpreters.start(self.logger)
+
+    def wait(self):
+        """ waits until all figures are written"""
+        return self.figures.wait()
+
+    def close(self):
+        self.figures.close()
+        if self.interpreter:
+            self.interpreter.close()
 
     def get_figdir(self):
         """ to easily create the figdir on the fly if needed"""
@@ -181,72 +216,89 @@ class PythonProcessor(BaseProcessor):
             os.mkdir(self.options['figdir'])
         return self.options['figdir']
 
-    def execute(self,codechunk,chunkoptions):
-        sys.stdout = self.stdout
-        sys.stderr = self.stderr
-        self.stdout.seek(0)
-        self.stderr.seek(0)
-        self.traceback.seek(0)
+    def _autoprint(self,coa,chunkoptions):
         try:
-            exec(codechunk.codeobject,self.globallocal,self.globallocal)
-            if self.ipc:
+            res = self.globallocal[coa]
+        except:
+            self.logger.warn('failed to autoprint "{0}"'.format(coa))
+            res = None
+        return hunks.CodeResult(subinterpreters.autoprint(coa,res,
+            chunkoptions.get('prec',3)))
+
+    def _trim(self,tr):
+        """ the traceback without the lines of rstscript"""
+        # remove all line until a line containing rstscript.dynamic except
+        # the first
+        st = tr.find('\n')+1
+        en = tr.find('File "{0}"'.format(self.inputfilename))
+        return tr[:st] + tr[en:] + '\n'
+
+    def execute(self,codechunks,chunkoptions):
+        """ executes some statements, their output is collected together,
+        except for a statement which fails, so its traceback stays in its
+        place"""
+        run = self._run_isolated if self.interpreter else self._run
+        while codechunks:
+            for n,stdout,stderr,tr,results in run(codechunks,chunkoptions):
+                yield hunks.CodeIn('\n'.join(codechunk.source
+                    for codechunk in codechunks[:n] if codechunk.source))
+                yield hunks.CodeStdErr(stderr)
+                yield hunks.CodeTraceback(tr)
+                yield hunks.CodeStdOut(stdout)
+                yield from results
+                codechunks = codechunks[n:]
+
+    def _run(self,codechunks,chunkoptions):
+        """ executes statements until one fails, returns the number of
+        statements, their stdout, stderr, traceback and results, for the
+        ones before the failing one and for the failing one"""
+        for buf in (self.stdout,self.stderr):
+            buf.seek(0)
+            buf.truncate()
+        results = []
+        failed = None
+        n = 0
+        with capture.capture(self.stdout,self.stderr):
+            for codechunk in codechunks:
+                n += 1
+                marks = self.stdout.tell(),self.stderr.tell()
                 try:
-                    self.ipc.run_cell(codechunk.source)
+                    exec(codechunk.codeobject,self.globallocal,self.globallocal)
+                    if self.ipc:
+                        try:
+                            self.ipc.run_cell(codechunk.source)
+                        except:
+                            self.logger.exception('failed to execute "{0}" on ipython'
+                            ' kernel "{1}"'.format(
+                                codechunk.source,os.path.split(self.ipc.cf)[0]))
                 except:
-                    self.logger.exception('failed to execute "{0}" on ipython'
-                    ' kernel "{1}"'.format(
-                        codechunk.source,os.path.split(self.ipc.cf)[0]))
-        except:
-            tr = traceback.format_exc().strip()
-            # remove all line until a line containing rstscript.dynamic except
-            # the first
-            st = tr.find('\n')+1
-            en = tr.find('File "{0}"'.format(self.inputfilename))
-            self.traceback.write(tr[:st])
-            self.traceback.write(tr[en:])
-            self.logger.warn('failed on line {0} with {1}'.
-                    format(codechunk.codeobject.co_firstlineno,tr[tr.rfind('\n')+1:]))
-        finally:
-            sys.stdout = self.stdout_sys
-            sys.stderr = self.stderr_sys
-        self.stdout.truncate()
-        self.stderr.truncate()
-        yield hunks.CodeIn(codechunk.source)
-        #print(codechunk.source)
-        yield hunks.CodeStdErr(self.stderr.getvalue())
-        self.stderr.seek(0)
-        self.stderr.truncate()
-        yield hunks.CodeTraceback(self.traceback.getvalue())
-        self.traceback.seek(0)
-        self.traceback.truncate()
-        yield hunks.CodeStdOut(self.stdout.getvalue())
-        self.stdout.seek(0)
-        self.stdout.truncate()
-        # for autoprinting
-        if codechunk.assign:
-            coa = codechunk.assign
-            try:
-                res = self.globallocal[coa]
-            except:
-                self.logger.warn('failed to autoprint "{0}"'.format(coa))
-                res = None
-            try:
-                res = float(res)
-                yield hunks.CodeResult('{0} = {1:.{2}f}'.
-                        format(coa,res,chunkoptions.get('prec',3)))
-            except:
-                # test if it can printed with latex
-                if hasattr(res,'atoms') and 'sympy' in sys.modules:
-                    import sympy
-                    yield hunks.CodeResult('{0} = {1}'.format(
-                        coa,res.evalf(n=chunkoptions.get('prec',3))))
-                    #yield hunks.MathBlock('{0} = {1}'.format(
-                        #coa,sympy.latex(res.evalf(n=chunkoptions.get('prec',3)))))
-                else:
-                    #self.logger.info('type is {0}:{1}'.format(coa,type(res)))
-                    yield hunks.CodeResult('{0} = {1}'.format(coa,res))
-
-        #return hunks.CHunk(cs,coo,cout,ce,ct,self.globallocal)
+                    failed = codechunk,traceback.format_exc().strip()
+                    break
+                # for autoprinting
+                if codechunk.assign and chunkoptions.get('a',False):
+                    results.append(self._autoprint(codechunk.assign,chunkoptions))
+        out,err = self.stdout.getvalue(),self.stderr.getvalue()
+        if not failed:
+            return [(n,out,err,'',results)]
+        # the log must not end up in the output
+        codechunk,tr = failed
+        self.logger.warn('failed on line {0} with {1}'.
+                format(codechunk.codeobject.co_firstlineno,tr[tr.rfind('\n')+1:]))
+        groups = [(n-1,out[:marks[0]],err[:marks[1]],'',results)] if n > 1 else []
+        return groups + [(1,out[marks[0]:],err[marks[1]:],self._trim(tr),[])]
+
+    def _run_isolated(self,codechunks,chunkoptions):
+        """ like ``_run``, in the subinterpreter of the project, the
+        namespace only gets the simple values back, for the templates"""
+        groups,values = self.interpreter.execute(codechunks,
+                chunkoptions.get('prec',3),chunkoptions.get('a',False))
+        self.globallocal.update(values)
+        for n,stdout,stderr,tr,results in groups:
+            if tr:
+                self.logger.warn('failed with {0}'.format(tr[tr.rfind('\n')+1:]))
+        return [(n,stdout,stderr,self._trim(tr) if tr else '',
+            [hunks.CodeResult(result) for result in results])
+            for n,stdout,stderr,tr,results in groups]
 
     def _saveallfigures(self,options,number):
         if not self.plt:
@@ -267,30 +319,44 @@ class PythonProcessor(BaseProcessor):
                 fig = self.plt.figure(num)
                 name = '{0}.png'.format(label)
                 figpath =os.path.join(self.get_figdir(),name)
-                fig.savefig(figpath)
-                self.logger.info('saved figure "{0}" to "{1}"'.format(label,figpath))
+                if self.options.get('draft',False):
+                    # previews don't need the quality of the final document
+                    fig.set_dpi(int(self.options.get('draftdpi',50)))
+                key = self.figures.save(fig,figpath,simplify=self.options.get('draft')
+                        and self.options.get('draftsimplify',False))
+                self.logger.info('saving figure "{0}" to "{1}"'.format(label,figpath))
                 # write only path relative to file, otherwise sphinx will complain
                 yield hunks.Figure(os.path.relpath(figpath,
                     os.path.split(self.options['woutput'])[0]),label=label,
                         desc=options.get('desc',''),
                         width=options.get('width','100%'),
                         height=options.get('height'),
-                        alt=options.get('alt',''))
+                        alt=options.get('alt',''),
+                        target=os.path.abspath(figpath),key=key)
 
     def process(self,chunk):
-        tree = ast.parse(chunk.raw)
         lhunks = []
-        for codechunk in self.visitor.visit(tree,chunk.lineNumber,chunk.raw.splitlines()):
-            for hunk in self.execute(codechunk,chunk.options):
-                # test if hunk is empty or not, only append not empty
-                if hunk.simple:
-                    lhunks.append(hunk)
+        codechunks = self.visitor.statements(chunk.raw,chunk.lineNumber)
+        # statements whose output is not shown separately are executed
+        # together, by default if neither echo nor autoprint is on
+        if chunk.options.get('batch',not (chunk.options.get('e',False) or
+                chunk.options.get('a',False))):
+            batches = [list(codechunks)]
+        else:
+            batches = ([codechunk] for codechunk in codechunks)
+        with self.report.measure('execute',chunk.number):
+            for batch in batches:
+                for hunk in self.execute(batch,chunk.options):
+                    # test if hunk is empty or not, only append not empty
+                    if hunk.simple:
+                        lhunks.append(hunk)
         # autosave figures TODO
         if chunk.options.get('af',False):
             try:
-                for fig in self._saveallfigures(chunk.options,chunk.number):
-                    lhunks.append(fig)
-                self.plt.close('all')
+                with self.report.measure('figures',chunk.number):
+                    for fig in self._saveallfigures(chunk.options,chunk.number):
+                        lhunks.append(fig)
+                    self.plt.close('all')
             except Exception as e:
                 self.logger.error('couldn\'t save figure, Exception {0}'.format(e))
 
@@ -0,0 +1,222 @@
+import os
+import re
+import bisect
+import hashlib
+import collections
+
+import rstscript
+
+"""
+Module to find the chunks of a document without copying it line by line.
+
+The input is read into one buffer and the delimiter lines are found with one
+regular expression over it. The result is an index of byte offsets and
+line numbers for every chunk, the content of a chunk is only decoded if
+somebody asks for it.
+
+The buffer is a copy of the file, not a memory map of it, so an editor which
+rewrites the file in place while we scan can't crash the daemon, and edits of
+line ranges can be applied to it. Only the
+chunks touching the edit are scanned again, the entries of the following
+chunks are just shifted.
+"""
+
+Entry = collections.namedtuple('Entry',
+        ['number','lineNumber','type','start','end','digest'])
+
+
+def readall(fd,size=1<<20):
+    """ the content of the file *fd* from its start, whatever happens to the
+    file meanwhile"""
+    parts = []
+    offset = 0
+    while True:
+        part = os.pread(fd,size,offset)
+        if not part:
+            return b''.join(parts)
+        parts.append(part)
+        offset += len(part)
+
+
+class Scanner(object):
+    """ builds the chunk index of a file object
+
+    Works with real files, which are read as bytes, and with everything else
+    which has a ``read`` method, like a StringIO.
+    """
+
+    def __init__(self,fileobject,start='%<',end='%>',comment='%%'):
+        if len(start) != len(end) != len(comment):
+            raise rstscript.RstscriptException('start end end tokens must have equal length')
+        self.encoding = getattr(fileobject,'encoding',None) or 'utf-8'
+        self.token_length = len(start)
+        self.start = start.encode(self.encoding)
+        self.comment = re.compile(b'^' + re.escape(comment.encode(self.encoding)),re.M)
+        self.delimiters = re.compile(b'^(' + re.escape(self.start) + b'|' +
+                re.escape(end.encode(self.encoding)) + b')',re.M)
+        try:
+            fd = fileobject.fileno()
+        except (AttributeError,IOError,OSError,ValueError):
+            # no real file
+            self.buffer = fileobject.read().encode(self.encoding)
+        else:
+            self.buffer = readall(fd)
+        self.index = [e._replace(number=i) for i,e in enumerate(self._scan(0,1))]
+        self.version = hashlib.sha1(self.buffer).hexdigest()
+
+    def _scan(self,pos,linenumber):
+        """ generates the entries starting at *pos*, which must be the start
+        of line *linenumber* outside of a code chunk"""
+        buf = self.buffer
+        view = memoryview(buf)
+
+        def entry(chunktype,linenumber,first,last):
+            h = hashlib.sha1(chunktype.encode('utf-8'))
+            h.update(view[first:last])
+            return Entry(None,linenumber,chunktype,first,last,h.hexdigest())
+
+        try:
+            #: counter for trvial error checking
+            delimitercounter = 0
+            #: position and line number of the current chunk start
+            chunkstart = pos
+            linen_of_chunkstart = linenumber
+            linecounter = linenumber
+            counted = pos
+            for match in self.delimiters.finditer(buf,pos):
+                pos = match.start()
+                linecounter += buf[counted:pos].count(b'\n')
+                counted = pos
+                if match.group(1) == self.start:
+                    if chunkstart < pos:
+                        yield entry('text',linen_of_chunkstart,chunkstart,pos)
+                    delimitercounter += 1
+                    linen_of_chunkstart = linecounter
+                    chunkstart = pos + self.token_length
+                else:
+                    if chunkstart < pos:
+                        yield entry('code',linen_of_chunkstart,chunkstart,pos)
+                    delimitercounter -= 1
+                    linen_of_chunkstart = linecounter + 1
+                    newline = buf.find(b'\n',pos)
+                    chunkstart = len(buf) if newline < 0 else newline + 1
+                # delimiter counter is 0 in text chunks and 1 in code chunks
+                # if it is smaller or bigger it must be an error
+                if delimitercounter > 1 or delimitercounter < 0:
+                    msg = 'missing delimiter before line {}'
+                    raise GeneratorExit(msg.format(linecounter))
+            if chunkstart < len(buf):
+                yield entry('text',linen_of_chunkstart,chunkstart,len(buf))
+        finally:
+            view.release()
+
+    def body(self,entry):
+        """ the content of a chunk with the comment tokens removed, for code
+        chunks the first line are the options"""
+        data = self.buffer[entry.start:entry.end]
+        if entry.type == 'code':
+            # the first line is the rest of the delimiter line
+            newline = data.find(b'\n') + 1
+            data = data[:newline] + self.comment.sub(b'',data[newline:])
+        else:
+            data = self.comment.sub(b'',data)
+        return data.decode(self.encoding).replace('\r\n','\n')
+
+    def close(self):
+        self.buffer = b''
+
+    def _linestart(self,entry):
+        # position and line number at which scanning can restart for the entry
+        if entry.type == 'code':
+            return entry.start - self.token_length,entry.lineNumber
+        return entry.start,entry.lineNumber
+
+    def _offset(self,linenumber):
+        """ byte offset of the start of a line"""
+        lines = [e.lineNumber for e in self.index]
+        k = bisect.bisect_right(lines,linenumber) - 1
+        pos,line = self._linestart(self.index[k]) if k >= 0 else (0,1)
+        while line < linenumber and pos < len(self.buffer):
+            newline = self.buffer.find(b'\n',pos)
+            pos = len(self.buffer) if newline < 0 else newline + 1
+            line += 1
+        return pos
+
+    def replace(self,first,last,text):
+        """ replaces the lines *first* to *last* (counted from 1, inclusive)
+        with *text*, for inserting lines before *first* let *last* be
+        ``first - 1``"""
+        data = text.encode(self.encoding)
+        a = self._offset(first)
+        b = self._offset(last + 1)
+        removed = self.buffer[a:b]
+        old_buffer = self.buffer
+        self.buffer = self.buffer[:a] + data + self.buffer[b:]
+        shift = len(data) - len(removed)
+        lineshift = data.count(b'\n') - removed.count(b'\n')
+        # restart at the first chunk touching the edit, its delimiter line
+        # must not be after the edit
+        k = 0
+        while k < len(self.index) and self.index[k].end < a:
+            k += 1
+        while k > 0 and (k == len(self.index) or self._linestart(self.index[k])[0] > a):
+            k -= 1
+        pos,line = self._linestart(self.index[k]) if self.index else (0,1)
+        if pos > a:
+            pos,line = 0,1
+        # old entries after the edit by their position in the new document
+        following = dict((e.start + shift,i)
+                for i,e in enumerate(self.index[k:],k) if e.start >= b)
+        new = []
+        tail = []
+        try:
+            for e in self._scan(pos,line):
+                i = following.get(e.start)
+                old = self.index[i] if i is not None else None
+                if (old and e.start >= a + len(data) and old.type == e.type and
+                        old.end + shift == e.end and
+                        old.lineNumber + lineshift == e.lineNumber):
+                    # from here on everything is like before
+                    tail = self.index[i:]
+                    break
+                new.append(e._replace(number=k + len(new)))
+        except GeneratorExit:
+            self.buffer = old_buffer
+            raise
+        n = k + len(new)
+        self.index = self.index[:k] + new + [o._replace(number=n + j,
+            start=o.start + shift,end=o.end + shift,
+            lineNumber=o.lineNumber + lineshift) for j,o in enumerate(tail)]
+        self.version = hashlib.sha1(self.buffer).hexdigest()
+        return len(new)
+
+
+def parse_diff(diff):
+    """ returns the replacements ``(first,last,text)`` of an unified diff,
+    last hunk first, so they can be applied one after the other"""
+    header = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+    replacements = []
+    lines = diff.splitlines(True)
+    i = 0
+    while i < len(lines):
+        match = header.match(lines[i])
+        i += 1
+        if not match:
+            continue
+        first = int(match.group(1))
+        count = int(match.group(2)) if match.group(2) is not None else 1
+        if count == 0:
+            # pure insertion after line *first*
+            first += 1
+        text = []
+        kind = ''
+        while i < len(lines) and not lines[i].startswith('@@'):
+            if lines[i][:1] in (' ','+'):
+                text.append(lines[i][1:])
+            elif lines[i].startswith('\\') and kind in (' ','+'):
+                # "\ No newline at end of file" of the new version
+                text[-1] = text[-1].rstrip('\n')
+            kind = lines[i][:1]
+            i += 1
+        replacements.append((first,first + count - 1,''.join(text)))
+    return list(reversed(replacements))
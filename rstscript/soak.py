@@ -0,0 +1,174 @@
+import os
+import gc
+import sys
+import shutil
+import argparse
+import tempfile
+import zmq
+from zmq.utils import jsonapi
+
+from rstscript import kernel
+from rstscript import loadtest
+from rstscript.main import run_locally
+
+"""
+Soak test of long running processes.
+
+The same project is run thousands of times, either like the daemon does,
+through the ZmqHandler with a push socket and a thread per request, or like
+``rstscript --no-daemon`` does, with ``run_locally``. Every some runs the
+resident memory, the number of python objects, the open file descriptors and
+the threads of the process are sampled. The test fails if they grew by more
+than the limits after the warm up runs.
+
+    python -m rstscript.soak --iterations 5000 --mode server
+"""
+
+MODES = ('server','local')
+
+#: allowed growth after the warm up
+LIMITS = {'rss':20480,'objects':5000,'fds':5,'threads':2}
+
+
+def usage():
+    """ resident memory in KB, python objects, open file descriptors and
+    threads of this process, None where we can't find out"""
+    gc.collect()
+    threads,rss = loadtest.process_stats(os.getpid())
+    try:
+        fds = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        fds = None
+    return {'rss':rss,'objects':len(gc.get_objects()),'fds':fds,
+            'threads':threads}
+
+
+class ServerRunner(object):
+    """ runs projects through a ZmqHandler, the way the daemon dispatches a
+    request, only that we are the client"""
+
+    def __init__(self):
+        self.context = zmq.Context()
+        self.handler = kernel.ZmqHandler(stop=None)
+        self.pull_sock = self.context.socket(zmq.PULL)
+        self.pull_sock.setsockopt(zmq.LINGER,0)
+        self.pull_port = self.pull_sock.bind_to_random_port('tcp://127.0.0.1')
+        self.answer_sock = self.context.socket(zmq.PAIR)
+        self.answer_sock.bind('inproc://soak')
+        self.stream = self.context.socket(zmq.PAIR)
+        self.stream.connect('inproc://soak')
+
+    def __call__(self,data):
+        data = dict(data,host='127.0.0.1',port=self.pull_port)
+        self.handler(self.stream,[jsonapi.dumps(['run',data])])
+        self.answer_sock.recv_json()
+        while True:
+            msg = self.pull_sock.recv_json()
+            if msg[0] == 'done':
+                return msg[1]
+
+    def close(self):
+        for project in self.handler.projects.values():
+            project.close()
+        for sock in (self.pull_sock,self.answer_sock,self.stream):
+            sock.close()
+        self.context.term()
+
+
+class LocalRunner(object):
+    """ runs projects like ``rstscript --no-daemon``, with a new Litrunner
+    every time"""
+
+    def __call__(self,data):
+        L = run_locally(dict(data,quiet=False,plugindir=''))
+        try:
+            L.run()
+        finally:
+            L.close()
+        return {'version':L.version}
+
+    def close(self):
+        pass
+
+
+def soak(mode='server',iterations=2000,chunks=20,edit=True,figures=0,
+        interval=100,warmup=100,limits=LIMITS):
+    """ runs a generated project *iterations* times, returns the samples,
+    the growth after *warmup* runs and the limits it exceeded"""
+    tmpdir = tempfile.mkdtemp()
+    runner = ServerRunner() if mode == 'server' else LocalRunner()
+    try:
+        project = loadtest.Project(os.path.join(tmpdir,'project'),chunks,
+                figures=figures)
+        samples = []
+        baseline = None
+        for i in range(1,iterations + 1):
+            if edit:
+                project.edit()
+            runner(project.data)
+            if i == warmup or i % interval == 0 or i == iterations:
+                sample = dict(usage(),iteration=i)
+                samples.append(sample)
+                if i == warmup:
+                    baseline = sample
+        baseline = baseline or samples[0]
+        growth = dict((key,samples[-1][key] - baseline[key]) for key in limits
+                if samples[-1][key] is not None and baseline[key] is not None)
+        exceeded = sorted(key for key,value in growth.items()
+                if value > limits[key])
+        return {'mode':mode,'iterations':iterations,'samples':samples,
+                'growth':growth,'exceeded':exceeded}
+    finally:
+        runner.close()
+        shutil.rmtree(tmpdir)
+
+
+def table(results):
+    lines = ['{0[mode]}: {0[iterations]} runs'.format(results),
+            '{0:>10}{1:>12}{2:>10}{3:>6}{4:>9}'.format('run','rss','objects',
+                'fds','threads')]
+    for s in results['samples']:
+        lines.append('{0:>10}{1:>10}KB{2:>10}{3:>6}{4:>9}'.format(
+            s['iteration'],*[s[key] if s[key] is not None else '?'
+                for key in ('rss','objects','fds','threads')]))
+    lines.append('growth after warm up: {0}'.format(', '.join(
+        '{0} {1:+}'.format(key,value) for key,value in sorted(results['growth'].items()))))
+    if results['exceeded']:
+        lines.append('FAILED, grew too much: {0}'.format(', '.join(results['exceeded'])))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='soak test of long running '
+            'processes')
+    parser.add_argument('--mode',nargs='*',default=list(MODES),choices=MODES,
+            help='run through the daemon handler or locally')
+    parser.add_argument('--iterations',type=int,default=2000,
+            help='how often the project is run')
+    parser.add_argument('--chunks',type=int,default=20,
+            help='number of text and code chunk pairs of the project')
+    parser.add_argument('--no-edit',dest='edit',action='store_false',
+            default=True,help='don\'t edit the document before every run')
+    parser.add_argument('--figures',type=int,default=0,
+            help='every that many code chunks makes a figure, 0 for none')
+    parser.add_argument('--interval',type=int,default=100,
+            help='runs between the samples')
+    parser.add_argument('--warmup',type=int,default=100,
+            help='runs before the growth is measured')
+    for key,default in sorted(LIMITS.items()):
+        parser.add_argument('--max-{0}'.format(key),dest=key,type=int,
+                default=default,help='allowed growth of {0}{1}'.format(key,
+                    ' in KB' if key == 'rss' else ''))
+    args = parser.parse_args(argv)
+    limits = dict((key,getattr(args,key)) for key in LIMITS)
+    failed = False
+    for mode in args.mode:
+        results = soak(mode,args.iterations,args.chunks,args.edit,args.figures,
+                args.interval,args.warmup,limits)
+        print(table(results))
+        failed = failed or bool(results['exceeded'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,110 @@
+import io
+import sys
+import marshal
+import traceback
+try:
+    from concurrent import interpreters
+except ImportError:
+    # before python 3.14
+    interpreters = None
+
+"""
+Module to execute the code of a project in a subinterpreter of its own.
+
+Every subinterpreter has its own GIL, its own modules and its own ``sys``, so
+the projects of the daemon execute on several cores and capture their output
+without stepping on each other, in one process. The statements are sent as
+marshalled code objects, which are executed by ``run`` inside the
+interpreter, in the namespace of this module there, and the output comes
+back as text.
+
+Only extension modules which support subinterpreters can be imported there,
+which excludes numpy and matplotlib at the moment, and the interpreters need
+python 3.14. Without them the processor executes in the thread, like always.
+"""
+
+#: the namespace of the project, every interpreter has its own copy of it
+namespace = {}
+
+#: values of these types are sent back for the templates
+SIMPLE = (bool,int,float,complex,str,bytes,type(None))
+
+
+def supported():
+    return interpreters is not None
+
+
+def autoprint(name,value,prec=3):
+    """ the text of the result of an assignment"""
+    try:
+        return '{0} = {1:.{2}f}'.format(name,float(value),prec)
+    except Exception:
+        # sympy expressions
+        if hasattr(value,'atoms') and 'sympy' in sys.modules:
+            return '{0} = {1}'.format(name,value.evalf(n=prec))
+        return '{0} = {1}'.format(name,value)
+
+
+def run(statements,prec=3):
+    """ executes the marshalled code objects of *statements*, a list of
+    ``(code,assign)``, in the namespace until one fails, returns the number
+    of statements, their stdout, stderr, traceback and the results of their
+    assignments, for the ones before the failing one and for the failing one,
+    and the simple values of the namespace, runs inside of the interpreter"""
+    stdout,stderr = io.StringIO(),io.StringIO()
+    tr = ''
+    results = []
+    n = 0
+    old = sys.stdout,sys.stderr
+    # our own sys, nobody else writes to it
+    sys.stdout,sys.stderr = stdout,stderr
+    try:
+        for code,assign in statements:
+            n += 1
+            marks = stdout.tell(),stderr.tell()
+            try:
+                exec(marshal.loads(code),namespace,namespace)
+            except Exception:
+                tr = traceback.format_exc().strip()
+                break
+            if assign:
+                results.append(autoprint(assign,namespace.get(assign),prec))
+    finally:
+        sys.stdout,sys.stderr = old
+    values = dict((key,value) for key,value in namespace.items()
+            if not key.startswith('__') and isinstance(value,SIMPLE))
+    out,err = stdout.getvalue(),stderr.getvalue()
+    if not tr:
+        return [(n,out,err,'',results)],values
+    groups = [(n-1,out[:marks[0]],err[:marks[1]],'',results)] if n > 1 else []
+    return groups + [(1,out[marks[0]:],err[marks[1]:],tr,[])],values
+
+
+class Interpreter(object):
+    """ a subinterpreter, which executes the statements of one project"""
+
+    def __init__(self):
+        self.interp = interpreters.create()
+        # it starts with the default path, but needs to find us
+        self.interp.exec('import sys\nsys.path[:] = {0!r}\n'.format(sys.path))
+
+    def execute(self,codechunks,prec=3,autoprint=True):
+        return self.interp.call(run,[(marshal.dumps(c.codeobject),
+            c.assign if autoprint else None) for c in codechunks],prec)
+
+    def close(self):
+        self.interp.close()
+
+
+def start(logger):
+    """ a new Interpreter, None if there are no subinterpreters"""
+    if not supported():
+        logger.info('python {0} has no subinterpreters, executing in the '
+                'thread'.format(sys.version.split()[0]))
+        return None
+    try:
+        return Interpreter()
+    except Exception as e:
+        logger.warn('couldn\'t start a subinterpreter, executing in the '
+                'thread: {0}'.format(e))
+        return None
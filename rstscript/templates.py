@@ -0,0 +1,134 @@
+import os
+import threading
+import jinja2
+from jinja2 import meta
+
+from rstscript import cache
+
+"""
+Module to render the text chunks with jinja2.
+
+All text chunks are compiled by one environment, which keeps the compiled
+templates by the digest of their text, so an unchanged paragraph is compiled
+only once, and optionally also writes the bytecode to disk for the next
+start. Text without any jinja markers isn't handed to jinja at all.
+
+The variables a text uses are found from its ast, so the dependency graph can
+tell which code chunks a text depends on, and a fingerprint of their values
+whether it needs to be rendered again. The fingerprint is only taken of values
+whose repr shows all of them, a text using anything else is always rendered
+again. A text calling something depends on all code before it, as a function
+can read any global.
+"""
+
+#: text without these is rendered as it is
+MARKERS = ('{{','{%','{#')
+#: stands for the whole namespace in the variables of a text which calls
+#: something, it is never defined
+CALLS = '()'
+#: types whose repr shows all of the value
+SIMPLE = (bool,int,float,complex,str,bytes,type(None))
+#: containers of these with more items are not fingerprinted
+MAX_ITEMS = 1000
+
+
+def is_plain(text):
+    """ True if the text contains no jinja markers"""
+    return not any(marker in text for marker in MARKERS)
+
+
+class Templates(object):
+    """ compiles and renders text chunks
+
+    *directory* is where the bytecode of the templates is kept, without it
+    they are only kept in memory, *size* is the number of compiled templates
+    kept in memory.
+    """
+
+    def __init__(self,directory=None,size=400):
+        self.sources = {}
+        self.lock = threading.Lock()
+        bytecode_cache = None
+        if directory:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+        self.env = jinja2.Environment(cache_size=size,
+                loader=jinja2.FunctionLoader(self._source),
+                bytecode_cache=bytecode_cache)
+
+    def _source(self,name):
+        # the source never changes for a digest
+        return self.sources[name],None,lambda: True
+
+    def get(self,text):
+        """ the compiled template of the text"""
+        key = cache.digest(text)
+        with self.lock:
+            self.sources[key] = text
+            try:
+                return self.env.get_template(key)
+            finally:
+                del self.sources[key]
+
+    def variables(self,text):
+        """ the names the text takes from the namespace"""
+        if is_plain(text):
+            return set()
+        try:
+            ast = self.env.parse(text)
+        except jinja2.TemplateSyntaxError:
+            return set()
+        names = meta.find_undeclared_variables(ast) - set(self.env.globals)
+        if any(True for call in ast.find_all(jinja2.nodes.Call)):
+            names.add(CALLS)
+        return names
+
+    def render(self,text,namespace):
+        if is_plain(text):
+            # like jinja, which drops a single trailing newline
+            return text[:-1] if text.endswith('\n') else text
+        return self.get(text).render(namespace)
+
+
+def simple(value):
+    """ True if the value is of a simple type or a small container of
+    them"""
+    todo = [value]
+    items = 0
+    while todo:
+        value = todo.pop()
+        items += 1
+        if items > MAX_ITEMS:
+            return False
+        if type(value) in (list,tuple,set,frozenset):
+            todo.extend(value)
+        elif type(value) == dict:
+            todo.extend(value.keys())
+            todo.extend(value.values())
+        elif not type(value) in SIMPLE:
+            return False
+    return True
+
+
+def fingerprint(namespace,names):
+    """ digest of the values of the names in the namespace, None if some
+    value isn't simple"""
+    if CALLS in names or not all(simple(namespace.get(name)) for name in names):
+        return None
+    return cache.digest(*['{0}={1!r}'.format(name,namespace.get(name))
+        for name in sorted(names)])
+
+
+def make_templates(options,logger):
+    """ returns the Templates for the app options, the bytecode is kept in
+    the cache directory if caching is enabled"""
+    directory = None
+    if options.get('cachedir') and not options.get('nocache'):
+        directory = os.path.join(options['cachedir'],'templates')
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        except (IOError,OSError) as e:
+            logger.error('couldn\'t use template directory "{0}": {1}'
+                    .format(directory,e))
+            directory = None
+    return Templates(directory)
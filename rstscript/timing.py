@@ -0,0 +1,135 @@
+import sys
+import time
+import json
+import types
+import contextlib
+import collections.abc
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+"""
+Module to measure where the time of a run goes.
+
+Every measurement is the wall time, the cpu time of the thread and the growth
+of the peak resident memory in KB of a phase (read, execute, figures, render,
+format, flush), either of a single chunk or of the whole document. The
+processors keep their own Report, the Litrunner collects them after every
+run.
+"""
+
+#: phases in the order they happen
+PHASES = ('read','execute','figures','render','format','flush')
+
+
+def peak_memory():
+    """ peak resident memory of the process in KB, 0 if we can't find out"""
+    if resource:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 0
+
+
+#: shared by everybody, not counted as memory of a namespace
+SHARED = (types.ModuleType,type,types.FunctionType,types.BuiltinFunctionType,
+        types.MethodType)
+
+
+def sizeof(obj,depth=4,seen=None):
+    """ approximate memory of an object and the containers and objects in
+    it, up to *depth* levels deep, in bytes, modules, classes and functions
+    are not counted"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj,SHARED):
+        return 0
+    seen.add(id(obj))
+    try:
+        size = sys.getsizeof(obj)
+    except Exception:
+        return 0
+    if depth:
+        if isinstance(obj,collections.abc.Mapping):
+            items = [x for item in obj.items() for x in item]
+        elif isinstance(obj,(list,tuple,set,frozenset,collections.deque)):
+            items = obj
+        else:
+            items = getattr(obj,'__dict__',{}).values()
+        for item in items:
+            size += sizeof(item,depth - 1,seen)
+    return size
+
+
+class Report(object):
+    """ measurements of a run, ``chunks`` maps chunk numbers to phases to
+    ``[wall,cpu,memory]``, ``document`` maps phases of the whole document to
+    the same"""
+
+    def __init__(self):
+        self.chunks = {}
+        self.document = {}
+
+    @contextlib.contextmanager
+    def measure(self,phase,number=None):
+        wall,cpu,memory = time.perf_counter(),time.thread_time(),peak_memory()
+        try:
+            yield
+        finally:
+            self.add(phase,number,[time.perf_counter() - wall,
+                time.thread_time() - cpu,peak_memory() - memory])
+
+    def add(self,phase,number,values):
+        phases = self.document if number is None else self.chunks.setdefault(number,{})
+        old = phases.get(phase,[0,0,0])
+        phases[phase] = [a + b for a,b in zip(old,values)]
+
+    def merge(self,chunks):
+        """ adds the chunk measurements of another report"""
+        for number,phases in chunks.items():
+            for phase,values in phases.items():
+                self.add(phase,int(number),values)
+
+    def take(self):
+        """ returns the chunk measurements and forgets them"""
+        chunks,self.chunks = self.chunks,{}
+        return chunks
+
+    def total(self,number):
+        return sum(values[0] for values in self.chunks.get(number,{}).values())
+
+    def as_dict(self):
+        return {'document':self.document,
+                'chunks':dict((str(n),p) for n,p in sorted(self.chunks.items()))}
+
+    def write(self,path):
+        with open(path,'w') as f:
+            json.dump(self.as_dict(),f,indent=1,sort_keys=True)
+
+    def comment(self,number):
+        """ the measurements of a chunk as rst comment"""
+        phases = self.chunks.get(number)
+        if not phases:
+            return ''
+        return '\n\n.. timing of chunk {0}: {1}\n'.format(number,', '.join(
+            '{0} {1[0]:.3f}s (cpu {1[1]:.3f}s)'.format(phase,phases[phase])
+            for phase in PHASES if phase in phases))
+
+    def table(self,n=10):
+        """ summary of the phases and the *n* slowest chunks"""
+        lines = ['{0:<10}{1:>10}{2:>10}{3:>12}'.format('phase','wall','cpu','memory')]
+        totals = {}
+        for phases in [self.document] + list(self.chunks.values()):
+            for phase,values in phases.items():
+                totals[phase] = [a + b for a,b in zip(totals.get(phase,[0,0,0]),values)]
+        for phase in PHASES:
+            if phase in totals:
+                lines.append('{0:<10}{1[0]:>9.3f}s{1[1]:>9.3f}s{1[2]:>10}KB'
+                        .format(phase,totals[phase]))
+        slowest = sorted(self.chunks,key=self.total,reverse=True)[:n]
+        if slowest:
+            lines.append('')
+            lines.append('{0:<10}{1:>10}'.format('chunk','wall'))
+            for number in slowest:
+                lines.append('{0:<10}{1:>9.3f}s'.format(number,self.total(number)))
+        return '\n'.join(lines)
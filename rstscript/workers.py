@@ -0,0 +1,367 @@
+import os
+import gc
+import queue
+import signal
+import socket
+import logging
+import importlib
+import itertools
+import threading
+import multiprocessing
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+
+from rstscript import utils
+from rstscript import litrunner
+from rstscript import checkpoint
+
+"""
+Module to run the projects of the daemon in worker processes.
+
+ client <-> daemon [WorkerPool] <-> worker 1 (LitServer, projects a, c)
+                                <-> worker 2 (LitServer, projects b)
+
+Every project is pinned to one worker, the first time it is seen it goes to
+the worker with the fewest projects, so its namespace survives between the
+runs. The daemon only routes the jobs to the workers and relays their log and
+done messages to the clients, the projects execute on as many cores as there
+are workers. If a worker dies, only the jobs of its projects fail, a new one
+takes its place, which starts its projects from scratch.
+
+The workers are started when they are needed, forked from a zygote process,
+which imported the modules to preload already and froze them for the garbage
+collector, so their memory stays shared and a new report doesn't wait for
+numpy or matplotlib to be imported.
+"""
+
+#: seconds to wait for the zygote to fork a worker, the first fork waits
+#: until it preloaded everything
+FORK_TIMEOUT = 120
+
+
+class Relay(object):
+    """ socket for ``utils.Logger`` which sends the messages of a job to
+    the daemon"""
+
+    def __init__(self,send,request):
+        self.send = send
+        self.request = request
+
+    def send_json(self,msg):
+        self.send(('log',self.request,msg))
+
+
+def _worker(conn,memorybudget,spilldir):
+    server = litrunner.LitServer(logging.getLogger('rstscript'),memorybudget,
+            spilldir)
+    lock = threading.Lock()
+    def send(msg):
+        with lock:
+            conn.send(msg)
+    def handle(request,data):
+        logger = utils.Logger(Relay(send,request),data.get('loglevel','WARN'))
+        try:
+            result = server.run(data,logger=logger)
+        except Exception as e:
+            logger.exception(e)
+            result = ['done',{}]
+        send(('done',request,result))
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError,OSError):
+            break
+        if msg[0] == 'stop':
+            break
+        threading.Thread(target=handle,args=msg[1:],daemon=True).start()
+    for project in list(server.projects.values()):
+        project.close()
+
+
+def preload(modules,logger,freeze=True):
+    """ imports the modules, with *freeze* the garbage collector leaves
+    everything alone which exists afterwards, so forked children don't copy
+    the memory"""
+    for name in modules:
+        try:
+            importlib.import_module(name)
+            logger.info('preloaded module "{0}"'.format(name))
+        except Exception as e:
+            logger.warn('couldn\'t preload module "{0}": {1}'.format(name,e))
+    if freeze and hasattr(gc,'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+def _reap(children):
+    for pid in list(children):
+        try:
+            if os.waitpid(pid,os.WNOHANG)[0]:
+                children.remove(pid)
+        except OSError:
+            children.remove(pid)
+
+
+def _zygote(conn,modules,memorybudget,spilldir):
+    preload(modules,logging.getLogger('rstscript'))
+    # the workers we forked and didn't reap yet, only their pids are ours
+    children = set()
+    while True:
+        _reap(children)
+        try:
+            if not conn.poll(1):
+                continue
+            msg = conn.recv()
+        except (EOFError,OSError):
+            break
+        if msg[0] == 'fork':
+            # the socket of the worker to the daemon
+            fd = reduction.recv_handle(conn)
+            pid = os.fork()
+            if not pid:
+                conn.close()
+                checkpoint._child(_forked_worker,fd,memorybudget,spilldir)
+            os.close(fd)
+            children.add(pid)
+            conn.send(('forked',pid))
+        elif msg[0] == 'kill':
+            if msg[1] in children:
+                try:
+                    os.kill(msg[1],signal.SIGTERM)
+                except OSError:
+                    pass
+        else:
+            break
+
+
+def _forked_worker(fd,memorybudget,spilldir):
+    # the processors wait for their own children
+    signal.signal(signal.SIGCHLD,signal.SIG_DFL)
+    _worker(Connection(fd),memorybudget,spilldir)
+    os._exit(0)
+
+
+class Zygote(object):
+    """ a process which imported the *modules* and forks the workers"""
+
+    def __init__(self,context,modules,memorybudget=0,spilldir=None):
+        self.context = context
+        self.args = (list(modules),memorybudget,spilldir)
+        self.lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self.conn,child = self.context.Pipe()
+        self.process = self.context.Process(target=_zygote,args=(child,)
+                + self.args,daemon=True)
+        self.process.start()
+        child.close()
+
+    def _stop(self):
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+    def fork(self):
+        """ a new worker, which has everything the zygote imported"""
+        with self.lock:
+            if not self.process.is_alive():
+                self.conn.close()
+                self._start()
+            ours,theirs = socket.socketpair()
+            try:
+                self.conn.send(('fork',))
+                reduction.send_handle(self.conn,theirs.fileno(),self.process.pid)
+                if not self.conn.poll(FORK_TIMEOUT):
+                    raise TimeoutError('the zygote didn\'t fork a worker in {0} '
+                            'seconds'.format(FORK_TIMEOUT))
+                kind,pid = self.conn.recv()
+            except (EOFError,OSError):
+                ours.close()
+                # a late answer would be taken for the next worker, the next
+                # fork starts a new zygote
+                self.process.terminate()
+                self._stop()
+                raise
+            finally:
+                theirs.close()
+        return Worker(Connection(ours.detach()),pid,zygote=self)
+
+    def kill(self,pid):
+        """ terminates the worker *pid*, if the zygote didn't reap it yet,
+        otherwise the pid may belong to somebody else already"""
+        with self.lock:
+            try:
+                self.conn.send(('kill',pid))
+            except (IOError,OSError):
+                pass
+
+    def close(self):
+        try:
+            self.conn.send(('stop',))
+        except (IOError,OSError):
+            pass
+        self._stop()
+
+
+class Worker(object):
+    """ a worker process and the jobs it didn't answer yet, *process* is
+    the multiprocessing Process if it is our child, otherwise *zygote* is
+    the Zygote it was forked from"""
+
+    def __init__(self,conn,pid,process=None,zygote=None):
+        self.conn = conn
+        self.pid = pid
+        self.process = process
+        self.zygote = zygote
+        #: the ids of the projects pinned to the worker
+        self.projects = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read,daemon=True)
+        self.reader.start()
+
+    @classmethod
+    def spawn(cls,context,memorybudget=0,spilldir=None):
+        """ a worker in a new python process, where there is no fork"""
+        conn,child = context.Pipe()
+        process = context.Process(target=_worker,args=(child,memorybudget,
+            spilldir),daemon=True)
+        process.start()
+        child.close()
+        return cls(conn,process.pid,process)
+
+    @property
+    def exitcode(self):
+        if self.process:
+            return self.process.exitcode
+
+    def submit(self,request,data):
+        """ sends a job to the worker, returns the queue its messages are
+        put in"""
+        answers = queue.Queue()
+        with self.lock:
+            self.pending[request] = answers
+            try:
+                self.conn.send(('run',request,data))
+            except (IOError,OSError):
+                del self.pending[request]
+                answers.put(('died',request,None))
+        return answers
+
+    def _read(self):
+        while True:
+            try:
+                kind,request,payload = self.conn.recv()
+            except (EOFError,OSError):
+                break
+            with self.lock:
+                if kind == 'done':
+                    answers = self.pending.pop(request,None)
+                else:
+                    answers = self.pending.get(request)
+            if answers:
+                answers.put((kind,request,payload))
+        # nobody is going to answer the rest
+        with self.lock:
+            pending,self.pending = self.pending,{}
+        for request,answers in pending.items():
+            answers.put(('died',request,None))
+
+    def close(self):
+        try:
+            with self.lock:
+                self.conn.send(('stop',))
+        except (IOError,OSError):
+            pass
+        if self.process:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        elif self.zygote:
+            self.reader.join(5)
+            if self.reader.is_alive():
+                # only the zygote knows if the pid is still the worker
+                self.zygote.kill(self.pid)
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """ *size* worker processes, which share the *memorybudget* in MB of the
+    daemon, the *preload* modules are imported before the workers fork"""
+
+    def __init__(self,size,logger,memorybudget=0,spilldir=None,preload=()):
+        self.logger = logger
+        self.context = multiprocessing.get_context('spawn')
+        self.memorybudget = float(memorybudget or 0)/size
+        self.spilldir = spilldir
+        self.lock = threading.Lock()
+        self.requests = itertools.count()
+        self.zygote = None
+        if hasattr(os,'fork'):
+            self.zygote = Zygote(self.context,preload,self.memorybudget,spilldir)
+        #: started when a project needs them
+        self.workers = [None]*size
+
+    def _start(self):
+        if self.zygote:
+            return self.zygote.fork()
+        return Worker.spawn(self.context,self.memorybudget,self.spilldir)
+
+    def assign(self,project_id):
+        """ the worker of the project, a new project goes to the worker with
+        the fewest projects"""
+        with self.lock:
+            for worker in self.workers:
+                if worker and project_id in worker.projects:
+                    return worker
+            index = min(range(len(self.workers)),key=lambda i:
+                    len(self.workers[i].projects) if self.workers[i] else 0)
+            if not self.workers[index]:
+                self.workers[index] = self._start()
+            self.workers[index].projects.add(project_id)
+            return self.workers[index]
+
+    def replace(self,worker):
+        """ forgets a dead worker, the next project gets a new one"""
+        with self.lock:
+            if worker in self.workers:
+                self.logger.error('worker {0} died with exit code {1}'
+                        .format(worker.pid,worker.exitcode))
+                self.workers[self.workers.index(worker)] = None
+        worker.close()
+
+    def run(self,data,relay):
+        """ runs the job of a client in the worker of its project, the log
+        messages are passed to *relay*, returns the done message"""
+        project_id = (data.get('input'),data.get('woutput'),data.get('toutput'))
+        try:
+            worker = self.assign(project_id)
+        except Exception as e:
+            self.logger.error('couldn\'t start a worker: {0}'.format(e))
+            relay(['log','ERROR::couldn\'t start a worker: {0}'.format(e)])
+            return ['done',{}]
+        answers = worker.submit(next(self.requests),data)
+        while True:
+            kind,request,payload = answers.get()
+            if kind == 'log':
+                relay(payload)
+            elif kind == 'done':
+                return payload
+            else:
+                relay(['log','ERROR::the worker of the project died, '
+                    'it starts from scratch with the next run'])
+                self.replace(worker)
+                return ['done',{}]
+
+    def close(self):
+        with self.lock:
+            workers,self.workers = self.workers,[]
+        for worker in workers:
+            if worker:
+                worker.close()
+        if self.zygote:
+            self.zygote.close()
@@ -4,6 +4,10 @@ import sys
 import logging
 import ast
 import logging
+import shutil
+import tempfile
+import marshal
+import jinja2
 from io import StringIO
 
 # Path hack.
@@ -11,6 +15,18 @@ from io import StringIO
 from rstscript import litrunner
 from rstscript import processors
 from rstscript import main
+from rstscript import cache
+from rstscript import depgraph
+from rstscript import scanner
+from rstscript import templates
+from rstscript import benchmark
+from rstscript import editbench
+from rstscript import loadtest
+from rstscript import soak
+from rstscript import workers
+from rstscript import subinterpreters
+from rstscript import capture
+from rstscript import figures
 
 def setup_base_litrunner():
     L = litrunner.Litrunner({},logging.getLogger('test'))
@@ -33,6 +49,74 @@ class LitTester(unittest.TestCase):
             for node in node_generator:
                 pass
 
+    def test_scanner(self):
+        S = scanner.Scanner(StringIO('text\n%<{"e":1}\na = 1\n%%b = 2\n%>x\n\nend'))
+        self.assertEqual([(e.type,e.lineNumber) for e in S.index],
+                [('text',1),('code',2),('text',6)])
+        self.assertEqual(S.body(S.index[1]),'{"e":1}\na = 1\nb = 2\n')
+        self.assertEqual(S.body(S.index[2]),'\nend')
+        S.close()
+
+    def test_scanner_file_truncated(self):
+        # an editor overwriting the document in place must not crash us
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(path,'w') as f:
+                f.write('text\n%<\na = 1\n%>\nend\n')
+            with open(path,'r') as f:
+                S = scanner.Scanner(f)
+            with open(path,'w') as f:
+                pass
+            self.assertEqual(S.body(S.index[1]),'\na = 1\n')
+        finally:
+            os.remove(path)
+
+    def test_unchanged_chunks_not_decoded(self):
+        L = setup_base_litrunner()
+        with open(self.testfile,'r') as f:
+            first = list(L.chunkify(f))
+        with open(self.testfile,'r') as f:
+            second = list(L.chunkify(f))
+        self.assertEqual([c.raw for c in second],[None]*len(first))
+        self.assertEqual([c.options for c in second],[c.options for c in first])
+        self.assertEqual(L.materialize(L.scanner.index[1]),first[1])
+
+    def test_scanner_replace(self):
+        document = 'text\n%<\na = 1\n%>\nmore\n%<\nb = 2\n%>\nend\n'
+        edits = [(3,3,'a = 3\n'),(5,5,'%<\nc = 1\n%>\n'),(1,0,'new\n'),
+                (2,4,''),(9,10,'')]
+        for first,last,text in edits:
+            S = scanner.Scanner(StringIO(document))
+            S.replace(first,last,text)
+            lines = document.splitlines(True)
+            edited = ''.join(lines[:first-1]) + text + ''.join(lines[last:])
+            fresh = scanner.Scanner(StringIO(edited))
+            self.assertEqual(S.index,fresh.index)
+            self.assertEqual(S.version,fresh.version)
+
+    def test_patch(self):
+        import difflib
+        document = 'text\n%<\na = 1\n%>\n%<\nb = 2\n%>\nend\n'
+        changed = document.replace('b = 2','b = 3').replace('end','{{b}}')
+        L = setup_base_litrunner()
+        list(L.read(StringIO(document)))
+        diff = ''.join(difflib.unified_diff(document.splitlines(True),
+            changed.splitlines(True)))
+        self.assertEqual(scanner.parse_diff(diff),
+                [(3,8,'a = 1\n%>\n%<\nb = 3\n%>\n{{b}}\n')])
+        self.assertFalse(L.patch({'version':'unknown','diff':diff}))
+        self.assertTrue(L.patch({'version':L.version,'diff':diff}))
+        self.assertEqual([chunk.number for chunk in L.read(None)],[2,3])
+        self.assertEqual(L.version,scanner.Scanner(StringIO(changed)).version)
+
+    def test_templates(self):
+        T = templates.Templates()
+        for text in ['plain\n','plain\n\n','plain','a {{b}}\n','{# c #}\n']:
+            self.assertEqual(T.render(text,{'b':1}),
+                    jinja2.Template(text).render({'b':1}))
+        self.assertIs(T.get('a {{b}}\n'),T.get('a {{b}}\n'))
+
     def test_tangle(self):
         L = litrunner.Litrunner({},logging.getLogger('test'))
         L.toutput = StringIO()
@@ -50,13 +134,720 @@ class LitTester(unittest.TestCase):
             for node in string_generator:
                 pass
 
+    def test_batch(self):
+        L = setup_base_litrunner()
+        document = "%<\nprint(1)\nx = 1/0\nprint(2)\n%>\n"
+        out = dict(L.format(L.weave(L.read(StringIO(document)))))
+        # the statement after the failing one still runs, the traceback
+        # stays in its place
+        text = ''.join(out[0])
+        self.assertLess(text.index('\t1'),text.index('ZeroDivisionError'))
+        self.assertLess(text.index('ZeroDivisionError'),text.index('\t2'))
+        self.assertNotIn('failed to autoprint',text)
+        # without the a option there is no result of the assignment
+        out = dict(L.format(L.weave(L.read(StringIO("%<\nx = 1\nprint(x)\n%>\n")))))
+        self.assertNotIn('x = 1.000',''.join(out[0]))
+
     def test_astvisitor(self):
         a = "b= lambda x: x*5 +5\ndef hhh(u):\n    b=19\n    return u*b\nm=hhh(9*4+5)"
         tree = ast.parse(a)
         visitor = processors.LitVisitor({},logging.getLogger('test'))
-        for node in visitor.visit(tree,1):
+        for node in visitor.visit(tree,1,a.splitlines()):
             pass
 
+
+class CacheTester(unittest.TestCase):
+    testfile = os.path.join(os.path.split(__file__)[0],'testfile.nw')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = {'input':self.testfile,
+                'woutput':os.path.join(self.tmpdir,'out.rst'),
+                'figdir':os.path.join(self.tmpdir,'_figures'),
+                'cachedir':os.path.join(self.tmpdir,'cache')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_digest_is_stable(self):
+        self.assertEqual(cache.digest('a','b'),cache.digest('a','b'))
+        self.assertNotEqual(cache.digest('ab'),cache.digest('a','b'))
+
+    def test_cold_start_from_cache(self):
+        L = litrunner.Litrunner(dict(self.options),logging.getLogger('test'))
+        self.assertTrue(L.run())
+        with open(self.options['woutput']) as f:
+            first = f.read()
+        L = litrunner.Litrunner(dict(self.options),logging.getLogger('test'))
+        self.assertTrue(L.run())
+        with open(self.options['woutput']) as f:
+            self.assertEqual(f.read(),first)
+        # nothing changed, so nothing had to be executed
+        self.assertEqual(L.processors,{})
+        self.assertEqual(len(L.skipped),len(L.chunks))
+
+    def test_unchanged_output_not_written(self):
+        L = litrunner.Litrunner(dict(self.options),logging.getLogger('test'))
+        path = self.options['woutput']
+        self.assertTrue(L.flush(path,'text'))
+        mtime = os.stat(path).st_mtime_ns
+        self.assertFalse(L.flush(path,'text'))
+        L = litrunner.Litrunner(dict(self.options),logging.getLogger('test'))
+        self.assertFalse(L.flush(path,'text'))
+        self.assertEqual(os.stat(path).st_mtime_ns,mtime)
+        self.assertTrue(L.flush(path,'other'))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),['cache','out.rst'])
+
+    def test_compile_cache(self):
+        directory = os.path.join(self.tmpdir,'code')
+        visitor = processors.LitVisitor('test.nw',logging.getLogger('test'),
+                compiled=cache.CompileCache(directory))
+        raw = 'import os\nx = (1 +\n    2)\n'
+        first = list(visitor.statements(raw,3))
+        self.assertEqual([c.source for c in first],['import os','x = (1 +\n    2)'])
+        # a new cache reads them from disk
+        visitor.compiled = cache.CompileCache(directory)
+        second = list(visitor.statements(raw,3))
+        self.assertEqual(second,first)
+        self.assertIn(5,[line for start,end,line in second[1].codeobject.co_lines()])
+        self.assertEqual(second[0].modules,['os'])
+
+    def test_report(self):
+        import json
+        report = os.path.join(self.tmpdir,'report.json')
+        L = litrunner.Litrunner(dict(self.options,report=report,annotate=True,
+            nocache=True),logging.getLogger('test'))
+        self.assertTrue(L.run())
+        with open(report) as f:
+            data = json.load(f)
+        self.assertIn('read',data['document'])
+        self.assertIn('execute',data['chunks']['1'])
+        self.assertEqual(len(data['chunks']['1']['execute']),3)
+        with open(self.options['woutput']) as f:
+            self.assertIn('.. timing of chunk 1: execute',f.read())
+        self.assertIn('execute',L.report.table())
+
+    def test_name_not_defined_anymore(self):
+        document = "%<\nx = 1\n%>\n%<\nx = 5\n%>\n%<\nprint(x)\n%>\n"
+        edits = [document.replace('x = 5','y = 5'),
+                document.replace('%<\nx = 5\n%>\n','')]
+        options = dict(self.options,input=os.path.join(self.tmpdir,'doc.nw'))
+        def run(L,text):
+            with open(options['input'],'w') as f:
+                f.write(text)
+            self.assertTrue(L.run())
+            with open(options['woutput']) as f:
+                return f.read()
+        for edit in edits:
+            shutil.rmtree(options['cachedir'],ignore_errors=True)
+            L = litrunner.Litrunner(dict(options),logging.getLogger('test'))
+            self.assertTrue(run(L,document).endswith('\t5'))
+            self.assertTrue(run(L,edit).endswith('\t1'))
+            L.close()
+            # the cache didn't keep the old output either
+            L = litrunner.Litrunner(dict(options),logging.getLogger('test'))
+            self.assertTrue(run(L,edit).endswith('\t1'))
+            L.close()
+
+    def test_report_without_daemon(self):
+        import json
+        import contextlib
+        report = os.path.join(self.tmpdir,'report.json')
+        stdout = StringIO()
+        with contextlib.redirect_stdout(stdout):
+            L = main.process_locally(dict(self.options,report=report,
+                timings=True,nocache=True,loglevel='ERROR'))
+        L.close()
+        self.assertIn('execute',stdout.getvalue())
+        with open(report) as f:
+            self.assertIn('execute',json.load(f)['chunks']['1'])
+
+    def test_eviction(self):
+        C = cache.ChunkCache(self.options['cachedir'],1000,logging.getLogger('test'))
+        for i in range(20):
+            C.set(cache.digest(str(i)),['x'*100])
+        self.assertLessEqual(C.size,1000)
+        self.assertEqual(C.get(cache.digest('19')),['x'*100])
+        self.assertIsNone(C.get(cache.digest('0')))
+
+
+class ServerTester(unittest.TestCase):
+    document = "%<\na = 1\n%>\n%<\nb = a + 1\nprint(b)\n%>\n"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = litrunner.LitServer(logging.getLogger('test'),
+                memorybudget=1e-6,spilldir=os.path.join(self.tmpdir,'spill'))
+
+    def tearDown(self):
+        for project in self.server.projects.values():
+            project.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_project(self,name,document):
+        data = {'input':os.path.join(self.tmpdir,name + '.nw'),
+                'woutput':os.path.join(self.tmpdir,name + '.rst'),
+                'toutput':None,'figdir':os.path.join(self.tmpdir,'_figures'),
+                'options':{},'nocache':True}
+        with open(data['input'],'w') as f:
+            f.write(document)
+        self.assertIn('version',self.server.run(data)[1])
+        with open(data['woutput']) as f:
+            return f.read()
+
+    def test_replaced_while_running(self):
+        data = {'input':os.path.join(self.tmpdir,'a.nw'),
+                'woutput':os.path.join(self.tmpdir,'a.rst'),'toutput':None,
+                'options':{},'nocache':True}
+        project_id = (data['input'],data['woutput'],None)
+        logger = logging.getLogger('test')
+        closed = []
+        class Processor(object):
+            def close(self):
+                closed.append(self)
+        first = self.server.activate(project_id,data,logger)
+        first.processors['python'] = Processor()
+        # new default options while the first run still goes on
+        second = self.server.activate(project_id,dict(data,options={'e':0}),logger)
+        self.assertIsNot(first,second)
+        self.assertEqual(closed,[])
+        self.server.release(project_id,first)
+        self.assertEqual(closed,[])
+        self.server.release(project_id,second)
+        self.assertEqual(len(closed),1)
+
+    def test_eviction(self):
+        self.run_project('a',self.document)
+        self.run_project('b',self.document)
+        # the budget is tiny, only the last project stays
+        self.assertEqual([p[0] for p in self.server.projects],
+                [os.path.join(self.tmpdir,'b.nw')])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir,'spill'))),1)
+        # the restored project replays the first chunk for the changed one
+        woven = self.run_project('a',self.document.replace('a + 1','a + 2'))
+        self.assertIn('3',woven)
+        self.assertNotIn('Error',woven)
+
+
+class WorkerTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = workers.WorkerPool(2,logging.getLogger('test'),
+                preload=['colorsys'])
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_project(self,name,document):
+        data = {'input':os.path.join(self.tmpdir,name + '.nw'),
+                'woutput':os.path.join(self.tmpdir,name + '.rst'),
+                'toutput':None,'figdir':os.path.join(self.tmpdir,'_figures'),
+                'options':{},'nocache':True,'loglevel':'INFO'}
+        with open(data['input'],'w') as f:
+            f.write(document)
+        logs = []
+        return self.pool.run(data,logs.append),logs
+
+    def test_affinity_and_crash(self):
+        done,logs = self.run_project('a','%<\nimport os\npid = os.getpid()\n%>\n')
+        self.assertIn('version',done[1])
+        self.assertTrue(logs)
+        self.run_project('b','%<\nx = 1\n%>\n')
+        self.assertEqual(sorted(len(w.projects) for w in self.pool.workers),[1,1])
+        # the worker of a dies, b doesn't notice
+        done,logs = self.run_project('a','%<\nimport os\nos._exit(1)\n%>\n')
+        self.assertEqual(done,['done',{}])
+        self.assertIn('died',logs[-1][1])
+        done,logs = self.run_project('b','%<\nx = 2\n%>\n')
+        self.assertIn('version',done[1])
+        self.assertEqual(len(self.pool.workers),2)
+
+    def test_preload(self):
+        self.run_project('a','%<\nimport sys\nprint("colorsys" in sys.modules)\n%>\n')
+        with open(os.path.join(self.tmpdir,'a.rst')) as f:
+            self.assertIn('True',f.read())
+
+    def test_zygote_kills_only_its_workers(self):
+        import time
+        zygote = self.pool.zygote
+        worker = zygote.fork()
+        # the test process is no child of the zygote
+        zygote.kill(os.getpid())
+        worker.close()
+        for i in range(50):
+            try:
+                os.kill(worker.pid,0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('the worker wasn\'t reaped')
+        worker = zygote.fork()
+        worker.close()
+
+    def test_fork_timeout(self):
+        with open(os.path.join(self.tmpdir,'slowmodule.py'),'w') as f:
+            f.write('import time\ntime.sleep(1)\n')
+        sys.path.insert(0,self.tmpdir)
+        timeout = workers.FORK_TIMEOUT
+        zygote = workers.Zygote(self.pool.context,['slowmodule'])
+        try:
+            workers.FORK_TIMEOUT = 0.2
+            self.assertRaises(TimeoutError,zygote.fork)
+            workers.FORK_TIMEOUT = timeout
+            # a new zygote takes its place
+            zygote.fork().close()
+        finally:
+            workers.FORK_TIMEOUT = timeout
+            sys.path.remove(self.tmpdir)
+            zygote.close()
+
+
+class DependencyTester(unittest.TestCase):
+    document = ("text\n%<\na = 1\n%>\n%<\nb = 2\n%>\n%<\nc = a + 1\n%>\n"
+            "%<\nl = [b]\n%>\n%<\nl.append(c)\n%>\n")
+
+    def chunks(self,document):
+        L = setup_base_litrunner()
+        return list(L.chunkify(StringIO(document)))
+
+    def test_names(self):
+        n = depgraph.names('import numpy as np\nx = np.zeros(3)\n'
+                'def f(y):\n    z = y\n    return z*w\nx.fill(1)')
+        self.assertEqual(n.defined,set(['np','x','f']))
+        self.assertIn('w',n.used)
+        self.assertEqual(n.mutated,set(['np','x']))
+        self.assertFalse(n.barrier)
+        self.assertTrue(depgraph.names('from pylab import *').barrier)
+        self.assertTrue(depgraph.names('exec("a=1")').barrier)
+
+    def test_graph(self):
+        graph = depgraph.DependencyGraph(self.chunks(self.document))
+        self.assertEqual(graph.deps[3],set([1]))
+        self.assertEqual(graph.deps[5],set([3,4]))
+        self.assertEqual(graph.select([2]),set([2,4,5]))
+        # rerunning the mutation needs a fresh list
+        self.assertEqual(graph.select([3]),set([3,4,5]))
+        self.assertEqual(graph.select([5]),set([4,5]))
+        self.assertEqual(graph.select([0]),set([0]))
+
+    def test_module_state(self):
+        document = ("%<\nimport math,random\nl = [1,2,3]\n%>\n%<\nrandom.seed(1)\n%>\n"
+                "%<\nprint(random.random())\n%>\n%<\nrandom.shuffle(l)\n%>\n"
+                "%<\nprint(l,math.sqrt(2))\n%>\n%<\nsetattr(random,'x',1)\n%>\n")
+        graph = depgraph.DependencyGraph(self.chunks(document))
+        self.assertEqual(graph.deps[2],set([1]))
+        self.assertEqual(graph.deps[4],set([0,3]))
+        self.assertEqual(graph.deps[5],set([3]))
+        self.assertIn(2,graph.select([1]))
+        # pure modules change nothing
+        self.assertNotIn('math',graph.names[4].defined)
+        self.assertNotIn('l',graph.names[4].defined)
+
+    def test_selective_read(self):
+        L = setup_base_litrunner()
+        self.assertEqual(len(list(L.read(StringIO(self.document)))),6)
+        changed = self.document.replace('c = a + 1','c = a + 2')
+        self.assertEqual([chunk.number for chunk in L.read(StringIO(changed))],[3,4,5])
+
+    def test_incremental_output(self):
+        def run(L,document):
+            for chunkn,formatted in L.format(L.weave(L.read(StringIO(document)))):
+                L.chunks[chunkn]['woven'] = formatted
+            return L
+        document = self.document.replace('c = a + 1','print(a)\nc = a + 1')
+        changed = document.replace('a = 1','a = 2')
+        L = run(run(setup_base_litrunner(),document),changed)
+        fresh = run(setup_base_litrunner(),changed)
+        self.assertEqual(L.tangled(),fresh.tangled())
+        self.assertEqual(L.woven(),fresh.woven())
+        self.assertIn('a = 2',L.tangled())
+
+    def test_text_variables(self):
+        document = "%<\na = 1\n%>\n%<\nb = 2\n%>\na is {{a}}\n"
+        L = setup_base_litrunner()
+        list(L.format(L.weave(L.read(StringIO(document)))))
+        self.assertEqual(L.graph.deps[2],set([0]))
+        changed = document.replace('b = 2','b = 3')
+        self.assertEqual([chunk.number for chunk in L.read(StringIO(changed))],[1])
+        # same value, so the text is not rendered again
+        changed = changed.replace('a = 1','a = 2 - 1')
+        L.templates.render = None
+        out = dict(L.format(L.weave(L.read(StringIO(changed)))))
+        self.assertEqual(out[2],['\n\na is 1\n'])
+
+    def test_text_unsimple_values(self):
+        document = ("%<\nl = list(range(3000))\nk = 1\ndef f():\n    return k\n%>\n"
+                "%<\nb = 0\n%>\nsum {{ l|sum }} f {{ f() }}\n")
+        L = setup_base_litrunner()
+        list(L.format(L.weave(L.read(StringIO(document)))))
+        self.assertIsNone(templates.fingerprint(L.dict,['l']))
+        self.assertIsNotNone(templates.fingerprint({'a':[1,'b',{2:None}]},['a']))
+        # a changed element of a big list and a global read by a function
+        changed = document.replace('b = 0','l[1500] = 0\nk = 5')
+        out = dict(L.format(L.weave(L.read(StringIO(changed)))))
+        self.assertEqual(out[2],['\n\nsum 4497000 f 5\n'])
+
+
+@unittest.skipUnless(hasattr(os,'fork'),'needs fork')
+class CheckpointTester(unittest.TestCase):
+    document = "%<\nl = []\n%>\n%<\nl.append(1)\n%>\n%<\nprint(len(l))\n%>\n"
+
+    def setUp(self):
+        self.L = litrunner.Litrunner({'checkpoints':1},logging.getLogger('test'))
+
+    def tearDown(self):
+        self.L.close()
+
+    def run_document(self,document):
+        return dict((chunkn,''.join(formatted)) for chunkn,formatted in
+                self.L.format(self.L.weave(self.L.read(StringIO(document)))))
+
+    def test_resume(self):
+        self.assertIn('\t1',self.run_document(self.document)[2])
+        processor = self.L.processors['python']
+        self.assertEqual(sorted(processor.snapshots),[0,1,2])
+        # resumes from the snapshot after chunk 1, so l is not appended twice
+        with self.assertLogs('test',level='INFO') as logs:
+            out = self.run_document(self.document.replace('len(l)','len(l),l'))
+        self.assertIn('\t1 [1]',out[2])
+        self.assertEqual(sorted(processor.snapshots),[0,1,2])
+        messages = '\n'.join(logs.output)
+        self.assertIn('resumed from snapshot after chunk "1"',messages)
+        self.assertNotIn('replaying chunk',messages)
+
+@unittest.skipUnless(hasattr(os,'fork'),'needs fork')
+class SessionTester(unittest.TestCase):
+    document = ("%<{'session':'a'}\nimport time;start = time.time()\n"
+            "time.sleep(0.5);x = 1;end = time.time()\n%>\n"
+            "%<{'session':'b'}\nimport time;start = time.time()\n"
+            "time.sleep(0.5);x = 2;end = time.time()\n%>\n"
+            "%<\nx = 3\n%>\n"
+            "%<{'session':'a'}\nprint(x)\n%>\n%<{'session':'b'}\nprint(x)\n%>\n")
+
+    def setUp(self):
+        self.L = setup_base_litrunner()
+
+    def tearDown(self):
+        self.L.close()
+
+    def test_sessions(self):
+        out = list(self.L.format(self.L.weave(self.L.read(StringIO(self.document)))))
+        # both sessions slept at the same time
+        a = self.L.processors[('python','a')].dict
+        b = self.L.processors[('python','b')].dict
+        self.assertLess(a['start'],b['end'])
+        self.assertLess(b['start'],a['end'])
+        self.assertEqual([chunkn for chunkn,formatted in out],[0,1,2,3,4])
+        self.assertIn('\t1',''.join(out[3][1]))
+        self.assertIn('\t2',''.join(out[4][1]))
+        self.assertEqual(self.L.processors['python'].dict['x'],3)
+
+    def test_locks_of_other_threads(self):
+        # a lock held by another thread of the daemon doesn't stay locked
+        # in the worker
+        import threading
+        held,release = threading.Event(),threading.Event()
+        def hold():
+            with cache._compile_caches_lock:
+                held.set()
+                release.wait(10)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        try:
+            out = dict(self.L.format(self.L.weave(self.L.read(
+                StringIO("%<{'session':'a'}\nprint(1)\n%>\n")))))
+        finally:
+            release.set()
+            thread.join()
+        self.assertIn('\t1',''.join(out[0]))
+
+    def test_unforkable_processor(self):
+        # the helper can't import the processor of a plugin module which
+        # exists only in the daemon, the session executes in the daemon
+        import types
+        module = types.ModuleType('rstscript_test_plugin')
+        module.Processor = type('Processor',(processors.PythonProcessor,),
+                {'name':'plugin','__module__':module.__name__})
+        sys.modules[module.__name__] = module
+        try:
+            self.L.register_processor(module.Processor)
+            with self.assertLogs('test',level='ERROR') as logs:
+                out = dict(self.L.format(self.L.weave(self.L.read(StringIO(
+                    "%<{'proc':'plugin','session':'a'}\nx = 2\nprint(x)\n%>\n"
+                    "%<{'proc':'plugin','session':'a'}\nprint(x + 1)\n%>\n")))))
+        finally:
+            del sys.modules[module.__name__]
+        self.assertIn('executing in the daemon','\n'.join(logs.output))
+        self.assertIn('\t2',''.join(out[0]))
+        self.assertIn('\t3',''.join(out[1]))
+
+    def test_history_after_insert(self):
+        # the session must not replay chunks of the old document
+        tmpdir = tempfile.mkdtemp()
+        document = ("%<{'session':'a'}\nx = 1\n%>\n%<\ny = 1\n%>\n"
+                "%<{'session':'a'}\nx += 1; print(x)\n%>\n")
+        L = litrunner.Litrunner({'cachedir':tmpdir},logging.getLogger('test'))
+        try:
+            list(L.format(L.weave(L.read(StringIO(document)))))
+            edit = ("%<\nz = 0\n%>\n" + document).replace('print(x)','print(x,0)')
+            out = dict(L.format(L.weave(L.read(StringIO(edit)))))
+            self.assertIn('\t2 0',''.join(out[3]))
+        finally:
+            L.close()
+            shutil.rmtree(tmpdir)
+
+    def test_wait_after_replay(self):
+        # the replayed session chunk is answered before the worker waits
+        tmpdir = tempfile.mkdtemp()
+        document = "%<{'session':'a'}\nx = 1\n%>\n%<\nprint(x)\n%>\n"
+        def run(document):
+            L = litrunner.Litrunner({'cachedir':tmpdir},logging.getLogger('test'))
+            list(L.format(L.weave(L.read(StringIO(document)))))
+            return L
+        try:
+            run(document).close()
+            L = run(document)
+            for edit in [document.replace('print(x)','print(x,1)'),
+                    document.replace('x = 1','x = 2;print(x)')]:
+                out = dict(L.format(L.weave(L.read(StringIO(edit)))))
+                self.assertTrue(L.processors[('python','a')].wait())
+            self.assertIn('\t2',''.join(out[0]))
+            L.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+class SubinterpreterTester(unittest.TestCase):
+    document = ("%<\nx = 2\nprint(x)\n%>\n%<{'a':1,'e':1}\ny = x*2\n%>\n"
+            "%<\n1/0\n%>\n")
+
+    def setUp(self):
+        self.L = litrunner.Litrunner({'subinterpreters':True},logging.getLogger('test'))
+
+    def tearDown(self):
+        self.L.close()
+
+    def test_run(self):
+        code = compile('print(3)\nz = 1.5\n','<test>','exec')
+        failing = compile('print(4)\n1/0\n','<test>','exec')
+        try:
+            groups,values = subinterpreters.run([(marshal.dumps(code),'z'),
+                (marshal.dumps(code),None),(marshal.dumps(failing),None),
+                (marshal.dumps(code),None)],prec=1)
+        finally:
+            subinterpreters.namespace.clear()
+        # split at the failing statement, the rest doesn't run
+        self.assertEqual(len(groups),2)
+        n,stdout,stderr,tr,results = groups[0]
+        self.assertEqual((n,stdout,tr,results),(2,'3\n3\n','',['z = 1.5']))
+        n,stdout,stderr,tr,results = groups[1]
+        self.assertEqual((n,stdout),(1,'4\n'))
+        self.assertIn('ZeroDivisionError',tr)
+        self.assertEqual(values,{'z':1.5})
+
+    def test_backend(self):
+        # in a subinterpreter where python has them, in the thread otherwise
+        out = dict((chunkn,''.join(formatted)) for chunkn,formatted in
+                self.L.format(self.L.weave(self.L.read(StringIO(self.document)))))
+        self.assertIn('\t2',out[0])
+        self.assertIn('y = 4.000',out[1])
+        self.assertIn('ZeroDivisionError',out[2])
+        self.assertEqual(self.L.processors['python'].dict['y'],4)
+
+    @unittest.skipUnless(sys.version_info >= (3,14),'needs python 3.14')
+    def test_assignments_in_subinterpreter(self):
+        out = dict((chunkn,''.join(formatted)) for chunkn,formatted in
+                self.L.format(self.L.weave(self.L.read(StringIO(
+                    "%<{'a':1}\nx = 2\ny = x*2\n%>\n")))))
+        self.assertIsNotNone(self.L.processors['python'].interpreter)
+        self.assertIn('y = 4.000',out[0])
+        self.assertEqual(self.L.processors['python'].dict['y'],4)
+
+class CaptureTester(unittest.TestCase):
+
+    def test_threads(self):
+        import threading
+        barrier = threading.Barrier(2)
+        buffers = {}
+        def work(name):
+            buffers[name] = StringIO(),StringIO()
+            with capture.capture(*buffers[name]):
+                for i in range(50):
+                    barrier.wait()
+                    print(name,end='')
+                    print(name,end='',file=sys.stderr)
+        threads = [threading.Thread(target=work,args=(name,)) for name in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in 'ab':
+            self.assertEqual([b.getvalue() for b in buffers[name]],[name*50]*2)
+
+    def test_concurrent_projects(self):
+        import threading
+        document = "%<\nimport time\nfor i in range(5):\n    print('{0}');time.sleep(0.01)\n%>\n"
+        out = {}
+        def work(name):
+            L = setup_base_litrunner()
+            try:
+                out[name] = ''.join(''.join(formatted) for chunkn,formatted in
+                    L.format(L.weave(L.read(StringIO(document.format(name))))))
+            finally:
+                L.close()
+        threads = [threading.Thread(target=work,args=(name,)) for name in 'xy']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(out['x'].count('\tx'),5)
+        self.assertNotIn('\ty',out['x'])
+        self.assertEqual(out['y'].count('\ty'),5)
+
+class BenchmarkTester(unittest.TestCase):
+
+    def test_run(self):
+        document = benchmark.generate(5,lines=2)
+        self.assertEqual(document.count('%<'),5)
+        results = benchmark.run([('generated',document)],repeat=1)
+        self.assertEqual(sorted(results),['generated:{0}'.format(stage)
+            for stage in sorted(benchmark.STAGES)])
+        self.assertGreater(results['generated:read']['lines_per_second'],0)
+        self.assertIn('generated:read',benchmark.table(results,[{'results':results}]))
+
+    def test_edit_latency(self):
+        lines,editable = editbench.synthetic(4,'chain',textlines=2)
+        self.assertEqual(len(editable),6)
+        index,make = editable[('code','end')]
+        self.assertEqual(lines[index],'x3 = x2 + 1\n')
+        for patch in (False,True):
+            results = editbench.measure(lines,editable,repeat=2,patch=patch)
+            self.assertEqual(results['code-middle']['runs'],2)
+            self.assertIn('text-end',editbench.table(results))
+
+    def test_load(self):
+        results = loadtest.run(clients=2,projects=1,requests=3,chunks=3,
+                edit=True,interval=0.1)
+        self.assertEqual(results['errors'],[])
+        self.assertEqual(results['requests'],6)
+        self.assertTrue(results['samples'])
+        self.assertIn('runs/s',loadtest.table(results))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/status'),'needs /proc')
+    def test_tree_stats(self):
+        # a grandchild, started by a thread which isn't the main one
+        import time
+        import threading
+        import subprocess
+        code = ('import subprocess,sys\nsubprocess.Popen([sys.executable,'
+                '"-c","import time;time.sleep(10)"]).wait()')
+        started = []
+        thread = threading.Thread(target=lambda: started.append(
+            subprocess.Popen([sys.executable,'-c',code])))
+        thread.start()
+        thread.join()
+        child = started[0]
+        try:
+            for i in range(50):
+                if loadtest.children(child.pid):
+                    break
+                time.sleep(0.1)
+            self.assertIn(child.pid,loadtest.children(os.getpid()))
+            # the grandchild has one thread
+            self.assertEqual(loadtest.tree_stats(child.pid)[0],
+                    loadtest.process_stats(child.pid)[0] + 1)
+        finally:
+            for pid in loadtest.children(child.pid):
+                os.kill(pid,9)
+            child.wait()
+
+    def test_soak(self):
+        for mode in soak.MODES:
+            results = soak.soak(mode,iterations=20,chunks=3,interval=10,warmup=10)
+            self.assertEqual(results['exceeded'],[])
+            self.assertEqual([s['iteration'] for s in results['samples']],[10,20])
+        results = soak.soak('local',iterations=2,chunks=2,interval=1,warmup=1,
+                limits={'objects':-10**9})
+        self.assertEqual(results['exceeded'],['objects'])
+        self.assertIn('FAILED',soak.table(results))
+
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+@unittest.skipUnless(matplotlib,'needs matplotlib')
+class FigureTester(unittest.TestCase):
+    document = ("%<{'af':True,'label':'line'}\nfrom matplotlib import pyplot\n"
+            "pyplot.plot([1,2])\n%>\n")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.options = {'figdir':os.path.join(self.tmpdir,'_figures'),
+                'woutput':os.path.join(self.tmpdir,'out.rst')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_document(self,**options):
+        self.options.update(options)
+        L = litrunner.Litrunner(self.options,logging.getLogger('test'))
+        try:
+            list(L.format(L.weave(L.read(StringIO(self.document)))))
+            L.wait()
+        finally:
+            L.close()
+        return os.path.join(self.options['figdir'],'line.png')
+
+    def test_background_writing(self):
+        from matplotlib import image
+        path = self.run_document(figureworkers=1)
+        self.assertEqual(image.imread(path).shape,(480,640,4))
+        # one pool for all projects of the process
+        writers = [figures.FigureWriter(1,logging.getLogger('test')) for i in range(2)]
+        self.assertIs(writers[0]._pool(),writers[1]._pool())
+
+    def test_draft(self):
+        from matplotlib import image
+        path = self.run_document(draft=True,draftdpi=50)
+        self.assertEqual(image.imread(path).shape,(240,320,4))
+        draft = litrunner.Litrunner(dict(self.options),logging.getLogger('test'))
+        final = litrunner.Litrunner(dict(self.options,draft=False),
+                logging.getLogger('test'))
+        self.assertNotEqual(draft.seed(),final.seed())
+
+    def test_figures_of_cached_chunks(self):
+        from matplotlib import image
+        cachedir = os.path.join(self.tmpdir,'cache')
+        path = self.run_document(cachedir=cachedir)
+        self.run_document(draft=True,draftdpi=50)
+        # taken from the cache, but with the figure of the final tier
+        self.assertEqual(image.imread(self.run_document(draft=False)).shape,
+                (480,640,4))
+        shutil.rmtree(self.options['figdir'])
+        self.assertEqual(image.imread(self.run_document()).shape,(480,640,4))
+
+    def test_unchanged_figure_not_written(self):
+        cachedir = os.path.join(self.tmpdir,'cache')
+        path = self.run_document(cachedir=cachedir,nocache=False)
+        mtime = os.stat(path).st_mtime_ns
+        self.assertEqual(self.run_document(rebuild=True),path)
+        self.assertEqual(os.stat(path).st_mtime_ns,mtime)
+        # the same figure of another project comes from the store
+        other = self.run_document(figdir=os.path.join(self.tmpdir,'other'))
+        self.assertEqual(os.stat(path).st_size,os.stat(other).st_size)
+        self.assertFalse(os.path.samefile(path,other))
+        # which doesn't touch the figure of the first one
+        self.run_document(figdir=os.path.join(self.tmpdir,'third'))
+        self.assertEqual(os.stat(path).st_mtime_ns,mtime)
+        # the chunk cache doesn't count the store
+        C = cache.make_cache(self.options,logging.getLogger('test'))
+        self.assertEqual(C.directory,os.path.join(cachedir,'chunks'))
+
 if '__main__' == __name__:
     #testify.run()
     unittest.main()